@@ -5,17 +5,45 @@ import sqlite3
 import configparser
 import os
 import csv
-from datetime import datetime
-from collections import defaultdict
-import shutil
+from datetime import datetime, timedelta, date as date_cls
+from collections import defaultdict, namedtuple, deque
 from pathlib import Path
 import decimal
-from collections import defaultdict
+import threading
+import queue
+import hashlib
+import time
+import argparse
+import bisect
+import mmap
+import struct
+import functools
+import asyncio
+import json
+import contextlib
+import math
+import sys
+from urllib.parse import urlsplit, parse_qs
+from array import array
 
 DB_FILE = "ledge.db"
+API_HOST = "127.0.0.1"
+API_PORT = 8765
+STARTUP_DEFER_MS = 10
+FILTER_DEBOUNCE_MS = 250
+FILTER_BATCH_SIZE = 500
+PRICE_DIR = "prices"
+VERIFY_INTERVAL_MS = 10 * 60 * 1000
+VERIFY_YIELD_ROWS = 1000
 
-def backup_database():
-    """Create a backup of the database file with timestamp."""
+sqlite3.register_adapter(decimal.Decimal, str)
+
+def backup_database(conn=None, prefix='ledge'):
+    """Create a timestamped backup of the database using the SQLite backup API.
+
+    Keeps the five most recent backups per prefix. If conn is given it is
+    used as the source, so uncommitted work on it is not included.
+    """
     if not Path(DB_FILE).exists():
         return
     
@@ -23,70 +51,2107 @@ def backup_database():
     backup_dir = Path('backups')
     backup_dir.mkdir(exist_ok=True)
     
-    backup_file = backup_dir / f'ledge_{timestamp}.db'
+    backup_file = backup_dir / f'{prefix}_{timestamp}.db'
+    source = conn or sqlite3.connect(DB_FILE)
     try:
-        shutil.copy2(DB_FILE, backup_file)
-        backups = sorted(backup_dir.glob('ledge_*.db'))
+        dest = sqlite3.connect(backup_file)
+        try:
+            source.backup(dest)
+        finally:
+            dest.close()
+        backups = sorted(backup_dir.glob(f'{prefix}_*.db'))
         if len(backups) > 5:
             for old_backup in backups[:-5]:
                 old_backup.unlink()
     except Exception as e:
         print(f'Failed to create backup: {e}')
+    finally:
+        if conn is None:
+            source.close()
+
+
+def ledger_version(conn):
+    """Return the change counter bumped by every write to transactions and by ACB repairs."""
+    row = conn.execute("SELECT value FROM ledger_meta WHERE key = 'ledger_version'").fetchone()
+    return row[0] if row else 0
+
+
+def acb_state_is_current(conn):
+    """True if acb_state was computed from the current ledger version."""
+    row = conn.execute("""
+        SELECT l.value = a.value
+        FROM ledger_meta l, ledger_meta a
+        WHERE l.key = 'ledger_version' AND a.key = 'acb_version'
+    """).fetchone()
+    return bool(row and row[0])
+
+
+def normalize_date(value):
+    """Normalize a date or timestamp string to YYYY-MM-DD."""
+    text = str(value).strip().replace('/', '-')[:10]
+    return datetime.strptime(text, "%Y-%m-%d").strftime("%Y-%m-%d")
+
+
+def transaction_fingerprint(date, action, token, token_amount, cad_amount,
+                            sent_token=None, sent_amount=None, sent_cad=None,
+                            ext_tx_id=None):
+    """Content hash identifying a transaction independent of its row id."""
+    def amount(value, places):
+        return f"{float(value or 0.0):.{places}f}"
+
+    parts = (
+        normalize_date(date),
+        str(action).strip().title(),
+        str(token or '').strip().upper(),
+        amount(token_amount, 8),
+        amount(cad_amount, 2),
+        str(sent_token or '').strip().upper(),
+        amount(sent_amount, 8),
+        amount(sent_cad, 2),
+        str(ext_tx_id or '').strip(),
+    )
+    return hashlib.sha1("|".join(parts).encode('utf-8')).hexdigest()
+
+
+def next_free_fingerprint(conn, base, exclude_id=None):
+    """Return (fingerprint, occurrence) for the first unused slot of base.
+
+    Identical transactions are allowed, but each repeat gets an ordinal
+    suffix so the unique index still tells them apart.
+    """
+    occurrence = 0
+    while True:
+        fingerprint = base if occurrence == 0 else f"{base}#{occurrence}"
+        row = conn.execute("SELECT id FROM transactions WHERE fingerprint = ?", (fingerprint,)).fetchone()
+        if row is None or row[0] == exclude_id:
+            return fingerprint, occurrence
+        occurrence += 1
+
+
+def renumber_fingerprints(conn, fingerprint):
+    """Renumber the repeats sharing fingerprint's base in id order.
+
+    Call after a row of the group is edited or deleted, so the suffixes
+    stay dense and the nth repeat is always base#n, as a re-import of the
+    same rows numbers them.
+    """
+    if not fingerprint:
+        return
+    base = fingerprint.split("#", 1)[0]
+    rows = conn.execute("SELECT id, fingerprint FROM transactions WHERE fingerprint = ? OR fingerprint GLOB ? ORDER BY id",
+                        (base, f"{base}#*")).fetchall()
+    updates = [(base if occurrence == 0 else f"{base}#{occurrence}", trans_id)
+               for occurrence, (trans_id, current) in enumerate(rows)
+               if current != (base if occurrence == 0 else f"{base}#{occurrence}")]
+    # Clear first so no update collides with a slot another row still holds.
+    conn.executemany("UPDATE transactions SET fingerprint = NULL WHERE id = ?", [(i,) for _, i in updates])
+    conn.executemany("UPDATE transactions SET fingerprint = ? WHERE id = ?", updates)
+
+
+def backfill_fingerprints(conn):
+    """Fill in fingerprints for rows written before the column existed."""
+    seen = defaultdict(int)
+    updates = []
+    cur = conn.execute("""
+        SELECT id, date, action, token, token_amount, cad_amount,
+               sent_token, sent_amount, sent_cad, ext_tx_id
+        FROM transactions
+        ORDER BY id
+    """)
+    for row in cur:
+        base = transaction_fingerprint(*row[1:])
+        occurrence = seen[base]
+        seen[base] += 1
+        updates.append((base if occurrence == 0 else f"{base}#{occurrence}", row[0]))
+    conn.executemany("UPDATE transactions SET fingerprint = ? WHERE id = ?", updates)
+
+
+def scan_duplicate_transactions(conn):
+    """Group transactions that share a content fingerprint.
+
+    Hashes every row once in a single pass, so the cost is linear in the
+    ledger size. Returns a list of id lists, one per duplicate group.
+    """
+    groups = defaultdict(list)
+    cur = conn.execute("""
+        SELECT id, date, action, token, token_amount, cad_amount,
+               sent_token, sent_amount, sent_cad, ext_tx_id
+        FROM transactions
+        ORDER BY id
+    """)
+    for row in cur:
+        groups[transaction_fingerprint(*row[1:])].append(row[0])
+    return [ids for ids in groups.values() if len(ids) > 1]
+
 
+# Stablecoins are priced at their peg's Bank of Canada rate.
+FX_ALIASES = {"USDT": "USD", "USDC": "USD"}
 
-def init_db():
+
+@functools.lru_cache(maxsize=4096)
+def _lookup_fx_rate(db_file, currency, date):
+    conn = sqlite3.connect(db_file)
     try:
-        conn = sqlite3.connect(DB_FILE)
-        conn.execute('''
-        CREATE TABLE IF NOT EXISTS transactions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TEXT NOT NULL CHECK (date GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'),
-            token TEXT NOT NULL,
-            action TEXT NOT NULL,
-            token_amount REAL NOT NULL,
-            cad_amount REAL NOT NULL,
-            notes TEXT,
-            sent_token TEXT,
-            sent_amount REAL,
-            sent_cad REAL,
-            fee_cad REAL DEFAULT 0.0,
-            gas_cad REAL DEFAULT 0.0
-        )
+        row = conn.execute(
+            "SELECT rate FROM fx_rates WHERE currency = ? AND date <= ? ORDER BY date DESC LIMIT 1",
+            (currency, date)
+        ).fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+
+def fx_rate(currency, date):
+    """CAD per unit of currency on date, using the latest published rate on or before it.
+
+    Lookups are memoized per (currency, date), so converting a large import
+    costs one indexed query per distinct date. Returns None if no rate is known.
+    """
+    currency = (currency or "CAD").strip().upper()
+    currency = FX_ALIASES.get(currency, currency)
+    if currency == "CAD":
+        return 1.0
+    return _lookup_fx_rate(DB_FILE, currency, normalize_date(date))
+
+
+def convert_to_cad(rate, *amounts):
+    """CAD values of amounts in another currency at rate, rounded to cents.
+
+    Every path that converts (import, the transaction dialog, edits) uses
+    this, so the same row is stored, and fingerprinted, the same way.
+    None stays None.
+    """
+    return tuple(None if amount is None else round(amount * rate, 2) for amount in amounts)
+
+
+def fx_currencies(conn):
+    """Currencies that can be converted to CAD with the loaded rates."""
+    loaded = [row[0] for row in conn.execute("SELECT DISTINCT currency FROM fx_rates ORDER BY currency")]
+    aliases = [alias for alias, target in sorted(FX_ALIASES.items()) if target in loaded]
+    return ["CAD"] + loaded + aliases
+
+
+def load_boc_fx_csv(conn, path):
+    """Load daily rates from a Bank of Canada Valet CSV (FXxxxCAD series).
+
+    Returns the number of (currency, date) rates stored.
+    """
+    rates = []
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        series = None
+        for row in csv.reader(f):
+            if not row:
+                continue
+            if row[0].strip().lower() == "date":
+                series = [
+                    (i, col.strip().upper()[2:-3]) for i, col in enumerate(row)
+                    if col.strip().upper().startswith("FX") and col.strip().upper().endswith("CAD")
+                ]
+                continue
+            if series is None:
+                continue
+            try:
+                date = normalize_date(row[0])
+            except ValueError:
+                continue
+            for i, currency in series:
+                try:
+                    rates.append((currency, date, float(row[i])))
+                except (ValueError, IndexError):
+                    continue
+    if not rates and series is None:
+        raise ValueError("No observations with a 'date' header found")
+    conn.executemany("INSERT OR REPLACE INTO fx_rates (currency, date, rate) VALUES (?, ?, ?)", rates)
+    _lookup_fx_rate.cache_clear()
+    return len(rates)
+
+
+IMPORT_COLUMNS = {
+    "Date": "date",
+    "Action": "action",
+    "Received Token": "token",
+    "Received Amount": "token_amount",
+    "Received CAD": "cad_amount",
+    "Sent Token": "sent_token",
+    "Sent Amount": "sent_amount",
+    "Sent CAD": "sent_cad",
+    "Exchange Fee (CAD)": "fee_cad",
+    "Gas Fee (CAD)": "gas_cad",
+    "Notes": "notes",
+    "External Tx ID": "ext_tx_id",
+    "Currency": "currency",
+    "Native Currency": "native_currency",
+    "FX Rate": "fx_rate",
+}
+VALID_ACTIONS = ("Buy", "Sell", "Trade", "Stake", "Unstake", "Reward", "Fee")
+
+
+def import_transactions_csv(conn, path, merge=False):
+    """Import transactions from a CSV laid out like the Export CSV file.
+
+    Rows whose fingerprint already exists are skipped, or with merge=True
+    used to fill in notes and fees missing on the stored row.
+    Each row costs one unique-index probe. Repeated identical rows within
+    the file are numbered, so re-importing the same file is a no-op.
+
+    Rows dated in a closed tax year are skipped if already archived and
+    rejected otherwise.
+
+    A Currency column marks the CAD columns as being in that currency; they
+    are converted with fx_rate. Native Currency and FX Rate, as written by
+    Export CSV, only record how already-converted values were obtained.
+    Returns (inserted, duplicates).
+    """
+    inserted = 0
+    duplicates = 0
+    seen = defaultdict(int)
+    closed = closed_through(conn)
+    closed_end = f"{closed:04d}-12-31" if closed is not None else None
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.DictReader(f)
+        for line_no, raw in enumerate(reader, start=2):
+            rec = {field: (raw.get(header) or '').strip() for header, field in IMPORT_COLUMNS.items()}
+            try:
+                date = normalize_date(rec["date"])
+                action = rec["action"].title()
+                if action not in VALID_ACTIONS:
+                    raise ValueError(f"unknown action '{rec['action']}'")
+                token = rec["token"].upper()
+                if not token:
+                    raise ValueError("token is empty")
+                token_amount = float(rec["token_amount"])
+                cad_amount = float(rec["cad_amount"] or 0.0)
+                sent_token = rec["sent_token"].upper() or None
+                sent_amount = float(rec["sent_amount"]) if rec["sent_amount"] else None
+                sent_cad = float(rec["sent_cad"]) if rec["sent_cad"] else None
+                fee_cad = float(rec["fee_cad"] or 0.0)
+                gas_cad = float(rec["gas_cad"] or 0.0)
+            except ValueError as e:
+                raise ValueError(f"Line {line_no}: {e}") from None
+            ext_tx_id = rec["ext_tx_id"] or None
+            notes = rec["notes"]
+
+            currency = rec["currency"].upper()
+            native_currency = rec["native_currency"].upper() or None
+            rate = float(rec["fx_rate"]) if native_currency and rec["fx_rate"] else None
+            if currency and currency != "CAD":
+                rate = fx_rate(currency, date)
+                if rate is None:
+                    raise ValueError(f"Line {line_no}: no {currency} exchange rate on or before {date}")
+                native_currency = currency
+                cad_amount, sent_cad, fee_cad, gas_cad = convert_to_cad(rate, cad_amount, sent_cad, fee_cad, gas_cad)
+
+            base = transaction_fingerprint(date, action, token, token_amount, cad_amount,
+                                           sent_token, sent_amount, sent_cad, ext_tx_id)
+            occurrence = seen[base]
+            seen[base] += 1
+            fingerprint = base if occurrence == 0 else f"{base}#{occurrence}"
+
+            if closed_end is not None and date <= closed_end:
+                if conn.execute("SELECT 1 FROM archived_transactions WHERE fingerprint = ?",
+                                (fingerprint,)).fetchone() is None:
+                    raise ValueError(f"Line {line_no}: {date} falls in closed tax year {date[:4]}")
+                duplicates += 1
+                continue
+
+            cur = conn.execute("""
+                INSERT INTO transactions
+                (date, token, action, token_amount, cad_amount, notes,
+                 sent_token, sent_amount, sent_cad, fee_cad, gas_cad, ext_tx_id, fingerprint,
+                 native_currency, fx_rate)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(fingerprint) DO NOTHING
+            """, (date, token, action, token_amount, cad_amount, notes,
+                  sent_token, sent_amount, sent_cad, fee_cad, gas_cad, ext_tx_id, fingerprint,
+                  native_currency, rate))
+            if cur.rowcount:
+                inserted += 1
+                continue
+            duplicates += 1
+            if merge:
+                conn.execute("""
+                    UPDATE transactions
+                    SET notes = CASE WHEN COALESCE(notes, '') = '' THEN ? ELSE notes END,
+                        fee_cad = CASE WHEN COALESCE(fee_cad, 0) = 0 THEN ? ELSE fee_cad END,
+                        gas_cad = CASE WHEN COALESCE(gas_cad, 0) = 0 THEN ? ELSE gas_cad END
+                    WHERE fingerprint = ?
+                """, (notes, fee_cad, gas_cad, fingerprint))
+    return inserted, duplicates
+
+
+def _migrate_base_schema(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        date TEXT NOT NULL CHECK (date GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'),
+        token TEXT NOT NULL,
+        action TEXT NOT NULL,
+        token_amount REAL NOT NULL,
+        cad_amount REAL NOT NULL,
+        notes TEXT,
+        sent_token TEXT,
+        sent_amount REAL,
+        sent_cad REAL,
+        fee_cad REAL DEFAULT 0.0,
+        gas_cad REAL DEFAULT 0.0
+    )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_trans_date ON transactions(date)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_trans_token ON transactions(token)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_trans_sent_token ON transactions(sent_token)')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS acb_state (
+        token TEXT PRIMARY KEY,
+        total_acb DECIMAL(28,18) NOT NULL DEFAULT 0.0,
+        units_held DECIMAL(28,18) NOT NULL DEFAULT 0.0
+    )
+    ''')
+
+
+def _migrate_fingerprints(conn):
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(transactions)')}
+    if 'ext_tx_id' not in columns:
+        conn.execute('ALTER TABLE transactions ADD COLUMN ext_tx_id TEXT')
+    if 'fingerprint' not in columns:
+        conn.execute('ALTER TABLE transactions ADD COLUMN fingerprint TEXT')
+        backfill_fingerprints(conn)
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_trans_fingerprint ON transactions(fingerprint)')
+
+
+def _migrate_ledger_meta(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS ledger_meta (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )
+    ''')
+    conn.execute("INSERT OR IGNORE INTO ledger_meta (key, value) VALUES ('ledger_version', 0)")
+    conn.execute("INSERT OR IGNORE INTO ledger_meta (key, value) VALUES ('acb_version', -1)")
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_trans_version_{event.lower()}
+        AFTER {event} ON transactions
+        BEGIN
+            UPDATE ledger_meta SET value = value + 1 WHERE key = 'ledger_version';
+        END
         ''')
-        
-        conn.execute('CREATE INDEX IF NOT EXISTS idx_trans_date ON transactions(date)')
-        conn.execute('CREATE INDEX IF NOT EXISTS idx_trans_token ON transactions(token)')
-        conn.execute('CREATE INDEX IF NOT EXISTS idx_trans_sent_token ON transactions(sent_token)')
-        conn.execute('CREATE INDEX IF NOT EXISTS idx_trans_action ON transactions(action)')
-        conn.execute('CREATE INDEX IF NOT EXISTS idx_trans_cad_amount ON transactions(cad_amount)')
-        
-        conn.execute('''
-        CREATE TABLE IF NOT EXISTS acb_state (
-            token TEXT PRIMARY KEY,
-            total_acb DECIMAL(28,18) NOT NULL DEFAULT 0.0,
-            units_held DECIMAL(28,18) NOT NULL DEFAULT 0.0
-        )
+
+
+def _migrate_drop_low_value_indexes(conn):
+    # Action has a handful of values and the amount filter ORs two columns,
+    # so neither index helps reads enough to pay for itself on every write.
+    conn.execute('DROP INDEX IF EXISTS idx_trans_action')
+    conn.execute('DROP INDEX IF EXISTS idx_trans_cad_amount')
+
+
+def _migrate_transaction_acb(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS transaction_acb (
+        transaction_id INTEGER PRIMARY KEY,
+        realized_gain REAL,
+        units_after REAL NOT NULL,
+        acb_per_unit_after REAL NOT NULL
+    )
+    ''')
+    # Force a replay on next start so the new table gets filled.
+    conn.execute("UPDATE ledger_meta SET value = -1 WHERE key = 'acb_version'")
+
+
+def _migrate_denied_loss(conn):
+    conn.execute('ALTER TABLE transaction_acb ADD COLUMN denied_loss REAL')
+    conn.execute("UPDATE ledger_meta SET value = -1 WHERE key = 'acb_version'")
+
+
+def _migrate_fx_rates(conn):
+    conn.execute('ALTER TABLE transactions ADD COLUMN native_currency TEXT')
+    conn.execute('ALTER TABLE transactions ADD COLUMN fx_rate REAL')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS fx_rates (
+        currency TEXT NOT NULL,
+        date TEXT NOT NULL,
+        rate REAL NOT NULL,
+        PRIMARY KEY (currency, date)
+    ) WITHOUT ROWID
+    ''')
+
+
+DEFAULT_RECEIPT_TOKENS = {
+    'sUSDe': 'USDe',
+    'sUSDC': 'USDC',
+    'stDOT': 'DOT',
+}
+
+# The receipt token of a Stake (received) or Unstake (given up) row. Queries
+# must repeat this expression verbatim to use idx_trans_receipt.
+RECEIPT_TOKEN_SQL = "CASE WHEN action = 'Stake' THEN sent_token ELSE token END"
+
+
+def _migrate_receipt_tokens(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS receipt_tokens (
+        receipt TEXT PRIMARY KEY COLLATE NOCASE,
+        original TEXT NOT NULL
+    ) WITHOUT ROWID
+    ''')
+    conn.executemany('INSERT OR IGNORE INTO receipt_tokens (receipt, original) VALUES (?, ?)',
+                     DEFAULT_RECEIPT_TOKENS.items())
+    conn.execute(f'''
+    CREATE INDEX IF NOT EXISTS idx_trans_receipt
+    ON transactions ({RECEIPT_TOKEN_SQL}, date, id)
+    WHERE action IN ('Stake', 'Unstake')
+    ''')
+
+
+TRANSACTION_COLUMNS = """id, date, token, action, token_amount, cad_amount, notes,
+                         sent_token, sent_amount, sent_cad, fee_cad, gas_cad,
+                         ext_tx_id, fingerprint, native_currency, fx_rate"""
+
+
+def _migrate_closed_years(conn):
+    # Rows of closed tax years move here unchanged, ids included, and their
+    # per-row replay results move to archived_transaction_acb.
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS archived_transactions (
+        id INTEGER PRIMARY KEY,
+        date TEXT NOT NULL,
+        token TEXT NOT NULL,
+        action TEXT NOT NULL,
+        token_amount REAL NOT NULL,
+        cad_amount REAL NOT NULL,
+        notes TEXT,
+        sent_token TEXT,
+        sent_amount REAL,
+        sent_cad REAL,
+        fee_cad REAL DEFAULT 0.0,
+        gas_cad REAL DEFAULT 0.0,
+        ext_tx_id TEXT,
+        fingerprint TEXT,
+        native_currency TEXT,
+        fx_rate REAL
+    )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_archived_date ON archived_transactions(date)')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_archived_fingerprint ON archived_transactions(fingerprint)')
+    conn.execute(f'''
+    CREATE INDEX IF NOT EXISTS idx_archived_receipt
+    ON archived_transactions ({RECEIPT_TOKEN_SQL}, date, id)
+    WHERE action IN ('Stake', 'Unstake')
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS archived_transaction_acb (
+        transaction_id INTEGER PRIMARY KEY,
+        realized_gain REAL,
+        units_after REAL NOT NULL,
+        acb_per_unit_after REAL NOT NULL,
+        denied_loss REAL
+    )
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS closed_years (
+        year INTEGER PRIMARY KEY,
+        closed_at TEXT NOT NULL,
+        archived_rows INTEGER NOT NULL
+    )
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS year_end_balances (
+        year INTEGER NOT NULL,
+        token TEXT NOT NULL,
+        total_acb DECIMAL(28,18) NOT NULL,
+        units_held DECIMAL(28,18) NOT NULL,
+        PRIMARY KEY (year, token)
+    )
+    ''')
+    # The live ledger starts from the balances at the end of the latest closed year.
+    conn.execute('''
+    CREATE VIEW IF NOT EXISTS opening_balances AS
+    SELECT year, token, total_acb, units_held
+    FROM year_end_balances
+    WHERE year = (SELECT MAX(year) FROM closed_years)
+    ''')
+    for event in ('INSERT', 'UPDATE'):
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_trans_closed_{event.lower()}
+        BEFORE {event} ON transactions
+        WHEN NEW.date <= (SELECT MAX(year) FROM closed_years) || '-12-31'
+        BEGIN
+            SELECT RAISE(ABORT, 'transaction date falls in a closed tax year');
+        END
         ''')
-        conn.commit()
+
+
+def _migrate_fee_gain(conn):
+    # Fee gains now include the ACB of the units given up; replay to restate them.
+    conn.execute("UPDATE ledger_meta SET value = -1 WHERE key = 'acb_version'")
+
+
+def _migrate_closing_acquisitions(conn):
+    # Acquisitions in the last days of the latest closed year, which can still
+    # make a loss early in the first open year superficial.
+    conn.execute(f'''
+    CREATE VIEW IF NOT EXISTS closing_acquisitions AS
+    SELECT id, date, token, token_amount
+    FROM archived_transactions
+    WHERE action IN ('Buy', 'Trade', 'Reward')
+      AND date > date((SELECT MAX(year) FROM closed_years) || '-12-31', '-{SUPERFICIAL_LOSS_DAYS} days')
+      AND date <= (SELECT MAX(year) FROM closed_years) || '-12-31'
+    ''')
+
+
+# Append-only: each step runs once, in order, and PRAGMA user_version
+# records how many have been applied. Never edit or reorder a shipped step.
+MIGRATIONS = [
+    _migrate_base_schema,
+    _migrate_fingerprints,
+    _migrate_ledger_meta,
+    _migrate_drop_low_value_indexes,
+    _migrate_transaction_acb,
+    _migrate_denied_loss,
+    _migrate_fx_rates,
+    _migrate_receipt_tokens,
+    _migrate_closed_years,
+    _migrate_fee_gain,
+    _migrate_closing_acquisitions,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate_db(conn):
+    """Apply pending migrations. Returns the number of steps run."""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version > SCHEMA_VERSION:
+        raise sqlite3.DatabaseError(
+            f"Database schema v{version} is newer than this version of Ledge supports (v{SCHEMA_VERSION})")
+    if version == SCHEMA_VERSION:
+        return 0
+
+    has_data = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'transactions'").fetchone()
+    if has_data:
+        backup_database(conn, prefix='premigration')
+
+    for number in range(version + 1, SCHEMA_VERSION + 1):
+        conn.execute('BEGIN')
+        try:
+            MIGRATIONS[number - 1](conn)
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return SCHEMA_VERSION - version
+
+
+def init_db(interactive=True):
+    conn = None
+    try:
+        conn = sqlite3.connect(DB_FILE)
+        migrate_db(conn)
+        # WAL lets readers (the API server, background jobs) run alongside writes.
+        if conn.execute('PRAGMA journal_mode').fetchone()[0] != 'wal':
+            conn.execute('PRAGMA journal_mode=WAL')
     except sqlite3.Error as e:
-        messagebox.showerror('Database Error', f'Failed to initialize database: {e}')
+        if interactive:
+            messagebox.showerror('Database Error', f'Failed to initialize database: {e}')
         raise
     finally:
         if conn:
             conn.close()
 
-RECEIPT_TO_ORIGINAL_MAP = {
-    'sUSDe': 'USDe',
-    'sUSDC': 'USDC',
-    'stDOT': 'DOT',
+def load_receipt_tokens(conn):
+    """Receipt token registry keyed by upper-cased receipt: {KEY: (receipt, original)}."""
+    return {receipt.upper(): (receipt, original)
+            for receipt, original in conn.execute("SELECT receipt, original FROM receipt_tokens ORDER BY receipt")}
+
+
+def save_receipt_token(conn, receipt, original):
+    conn.execute("""
+        INSERT INTO receipt_tokens (receipt, original) VALUES (?, ?)
+        ON CONFLICT(receipt) DO UPDATE SET receipt = excluded.receipt, original = excluded.original
+    """, (receipt, original))
+
+
+def delete_receipt_token(conn, receipt):
+    conn.execute("DELETE FROM receipt_tokens WHERE receipt = ?", (receipt,))
+
+
+StakeLink = namedtuple("StakeLink", "unstake_id stake_id receipt receipt_units original_units basis_cad")
+StakingPosition = namedtuple("StakingPosition",
+                             "stake_id date receipt original receipt_units original_units basis_cad")
+
+
+class StakingLineage:
+    """FIFO links from Unstake rows back to the Stake rows they redeem, per receipt token.
+
+    Only Stake and Unstake rows are read, live and archived, through the
+    partial receipt indexes, so the cost does not grow with the rest of the
+    ledger.
+    A Stake's basis is its CAD value; partial unstakes consume lots pro rata.
+    """
+
+    def __init__(self, conn):
+        self.lots = defaultdict(deque)
+        self.links = []
+        self._links_by_id = defaultdict(list)
+        self.unmatched = defaultdict(float)
+        cur = conn.execute(f"""
+            SELECT id, date, action, {RECEIPT_TOKEN_SQL} AS receipt,
+                   token, token_amount, sent_amount, cad_amount
+            FROM archived_transactions
+            WHERE action IN ('Stake', 'Unstake')
+            UNION ALL
+            SELECT id, date, action, {RECEIPT_TOKEN_SQL},
+                   token, token_amount, sent_amount, cad_amount
+            FROM transactions
+            WHERE action IN ('Stake', 'Unstake')
+            ORDER BY 4, 2, 1
+        """)
+        for trans_id, date, action, receipt, token, token_amt, sent_amt, cad_amt in cur:
+            if not receipt:
+                continue
+            if action == "Stake":
+                self.lots[receipt].append([trans_id, date, token, sent_amt or 0.0, token_amt or 0.0, cad_amt or 0.0])
+            else:
+                self._redeem(trans_id, receipt, token_amt or 0.0)
+
+    def _redeem(self, unstake_id, receipt, units):
+        lots = self.lots[receipt]
+        while units > 1e-12 and lots:
+            lot = lots[0]
+            stake_id, _, _, lot_units, lot_original, lot_basis = lot
+            take = min(units, lot_units)
+            share = take / lot_units if lot_units else 1.0
+            link = StakeLink(unstake_id, stake_id, receipt, take, lot_original * share, lot_basis * share)
+            self.links.append(link)
+            self._links_by_id[unstake_id].append(link)
+            self._links_by_id[stake_id].append(link)
+            lot[3] -= take
+            lot[4] -= lot_original * share
+            lot[5] -= lot_basis * share
+            units -= take
+            if lot[3] <= 1e-12:
+                lots.popleft()
+        if units > 1e-12:
+            self.unmatched[receipt] += units
+
+    def links_for(self, trans_id):
+        """Links that redeem the Stake trans_id, or that the Unstake trans_id redeems."""
+        return self._links_by_id.get(trans_id, [])
+
+    def open_positions(self):
+        return [StakingPosition(lot[0], lot[1], receipt, lot[2], lot[3], lot[4], lot[5])
+                for receipt, lots in sorted(self.lots.items()) for lot in lots]
+
+
+def staking_report(conn, prices, date):
+    """Open staking positions with market value and accrual since staking, for the report.
+
+    The receipt token's price is used when known; otherwise the original
+    token's price applied to the original units staked. Each position
+    lists the unstakes that have already redeemed part of it.
+    """
+    report = []
+    lineage = StakingLineage(conn)
+    for pos in lineage.open_positions():
+        price = prices.price_on(pos.receipt, date) if prices is not None else None
+        if price is not None:
+            value = pos.receipt_units * price
+        else:
+            price = prices.price_on(pos.original, date) if prices is not None else None
+            value = pos.original_units * price if price is not None else None
+        report.append({
+            "stake_id": pos.stake_id,
+            "date": pos.date,
+            "receipt": pos.receipt,
+            "original": pos.original,
+            "receipt_units": pos.receipt_units,
+            "original_units": pos.original_units,
+            "basis_cad": pos.basis_cad,
+            "value_cad": value,
+            "accrued_cad": value - pos.basis_cad if value is not None else None,
+            "unstakes": [(link.unstake_id, link.receipt_units) for link in lineage.links_for(pos.stake_id)],
+        })
+    return report
+
+
+LEDGER_COLUMNS = """id, date, token, action, token_amount, cad_amount,
+                    sent_token, sent_amount, sent_cad, fee_cad, gas_cad"""
+
+LedgerStep = namedtuple("LedgerStep", [
+    "trans_id", "date", "action", "token", "realized_gain", "units_after", "acb_per_unit_after",
+    "disposed_token", "disposed_units", "proceeds", "cost_basis", "outlays", "denied_loss",
+    "fee_cad", "gas_cad", "sent_token",
+])
+
+SUPERFICIAL_LOSS_DAYS = 30
+
+# One signed unit movement per token leg of each transaction in source,
+# after one opening leg per balance carried in.
+LEGS_SQL = """
+    SELECT token AS leg_token, date, id, action,
+           CASE WHEN action IN ('Sell', 'Fee', 'Stake', 'Unstake') THEN -token_amount
+                ELSE token_amount END AS delta
+    FROM {source}
+    UNION ALL
+    SELECT sent_token, date, id, action,
+           CASE WHEN action = 'Trade' THEN -sent_amount ELSE sent_amount END
+    FROM {source}
+    WHERE action IN ('Trade', 'Stake', 'Unstake')
+      AND sent_token IS NOT NULL AND sent_amount IS NOT NULL
+    UNION ALL
+    SELECT token, year || '-12-31', 0, 'Opening', units_held
+    FROM {opening}
+"""
+LEDGER_LEGS_SQL = LEGS_SQL.format(source="transactions", opening="opening_balances")
+
+
+class AcquisitionIndex:
+    """Per-token acquisitions and holdings by day, for superficial-loss checks.
+
+    Built from two ordered scans into compact sorted arrays, so each window
+    query is a pair of binary searches rather than a scan of the ledger.
+    By default it covers the live ledger; source, opening and closed_year
+    describe another starting point, as replay_source builds for a date in
+    a closed year.
+    """
+
+    def __init__(self, conn=None, source="transactions", opening="opening_balances",
+                 closed_year="(SELECT MAX(year) FROM closed_years)"):
+        self.acquired_days = {}
+        self.acquired_units = {}
+        self.held_days = {}
+        self.held_units = {}
+        self._ordinals = {}
+        if conn is None:
+            return
+        # Acquisitions late in the closed year the replay starts from still
+        # count for losses early in the year after it.
+        for token, date, amount, _ in conn.execute(f"""
+            SELECT token, date, token_amount, id FROM {source}
+            WHERE action IN ('Buy', 'Trade', 'Reward')
+            UNION ALL
+            SELECT token, date, token_amount, id FROM archived_transactions
+            WHERE action IN ('Buy', 'Trade', 'Reward')
+              AND date > date({closed_year} || '-12-31', '-{SUPERFICIAL_LOSS_DAYS} days')
+              AND date <= {closed_year} || '-12-31'
+            ORDER BY 1, 2, 4
+        """):
+            self._append(self.acquired_days, self.acquired_units, token, date, amount)
+        for token, date, amount in conn.execute(f"""
+            SELECT leg_token, date, delta FROM ({LEGS_SQL.format(source=source, opening=opening)})
+            ORDER BY leg_token, date, id
+        """):
+            self._append(self.held_days, self.held_units, token, date, amount)
+
+    @classmethod
+    def from_rows(cls, rows, opening=(), acquired=()):
+        """Build the index from LEDGER_COLUMNS rows already in (date, id) order.
+
+        opening holds (token, date, units) balances carried in from before
+        the first row, and acquired the (token, date, units) acquisitions
+        before it that still fall in the superficial-loss window.
+        """
+        index = cls()
+        for token, date, units in opening:
+            index._append(index.held_days, index.held_units, token, date, units)
+        for token, date, units in acquired:
+            index._append(index.acquired_days, index.acquired_units, token, date, units)
+        for row in rows:
+            (_, date, token, action, token_amt, _, sent_token, sent_amt) = row[:8]
+            if action in ("Buy", "Trade", "Reward"):
+                index._append(index.acquired_days, index.acquired_units, token, date, token_amt)
+            sign = -1 if action in ("Sell", "Fee", "Stake", "Unstake") else 1
+            index._append(index.held_days, index.held_units, token, date, sign * token_amt)
+            if action in ("Trade", "Stake", "Unstake") and sent_token and sent_amt is not None:
+                sign = -1 if action == "Trade" else 1
+                index._append(index.held_days, index.held_units, sent_token, date, sign * sent_amt)
+        return index
+
+    @staticmethod
+    def _append(days_by_token, cumulative_by_token, token, date, amount):
+        # cumulative[i] is the running total before days[i]; one extra slot at the end.
+        days = days_by_token.get(token)
+        if days is None:
+            days = days_by_token[token] = array('l')
+            cumulative_by_token[token] = array('d', [0.0])
+        cumulative = cumulative_by_token[token]
+        days.append(date_cls.fromisoformat(date).toordinal())
+        cumulative.append(cumulative[-1] + (amount or 0.0))
+
+    def units_acquired(self, token, day, window=SUPERFICIAL_LOSS_DAYS):
+        """Units of token acquired from window days before to window days after day."""
+        days = self.acquired_days.get(token)
+        if not days:
+            return 0.0
+        cumulative = self.acquired_units[token]
+        return (cumulative[bisect.bisect_right(days, day + window)]
+                - cumulative[bisect.bisect_left(days, day - window)])
+
+    def units_held(self, token, day):
+        """Units of token held at the end of day."""
+        days = self.held_days.get(token)
+        if not days:
+            return 0.0
+        return max(0.0, self.held_units[token][bisect.bisect_right(days, day)])
+
+    def denied_fraction(self, token, date, units):
+        """Share of a loss on disposing units of token on date that is superficial.
+
+        CRA denies the loss in proportion to the least of the units disposed,
+        the units acquired in the 61-day window around the sale, and the
+        units still held at the end of that window.
+        """
+        if units <= 0:
+            return ZERO
+        day = self._ordinals.get(date)
+        if day is None:
+            day = self._ordinals[date] = date_cls.fromisoformat(date).toordinal()
+        substituted = min(self.units_acquired(token, day),
+                          self.units_held(token, day + SUPERFICIAL_LOSS_DAYS))
+        if substituted <= 0:
+            return ZERO
+        return min(ONE, to_decimal(substituted) / units)
+
+
+# Every ledger calculation runs in this one context: fixed 34-digit precision
+# (decimal128) with no traps, so no signal checks per operation. Values are
+# quantized only where they leave the engine.
+LEDGER_CONTEXT = decimal.Context(prec=34, rounding=decimal.ROUND_HALF_EVEN, traps=[])
+ZERO = decimal.Decimal(0)
+ONE = decimal.Decimal(1)
+CENT = decimal.Decimal("0.01")
+UNIT_QUANTUM = decimal.Decimal("0.00000001")
+RATE_QUANTUM = decimal.Decimal("0.0001")
+
+
+def to_decimal(value):
+    """Decimal for a stored amount; floats go through repr, so 0.1 stays 0.1."""
+    if not value:
+        return ZERO
+    return decimal.Decimal(repr(value) if value.__class__ is float else value)
+
+
+class TokenState:
+    """Running ACB state of one token."""
+
+    __slots__ = ("total_acb", "units_held")
+
+    def __init__(self, total_acb=ZERO, units_held=ZERO):
+        self.total_acb = total_acb
+        self.units_held = units_held
+
+    def acb_per_unit(self):
+        return self.total_acb / self.units_held if self.units_held > 0 else ZERO
+
+
+def new_acb_state():
+    return defaultdict(TokenState)
+
+
+def replay_ledger(rows, acb_state, acquisitions=None):
+    """Replay ledger rows in (date, id) order, updating acb_state in place.
+
+    rows are tuples of LEDGER_COLUMNS. Yields a LedgerStep per row with the
+    realized gain (None if the row disposes of nothing) and the row token's
+    units and ACB per unit after the row is applied. Rows that dispose of a
+    token (Sell, the sent leg of a Trade, Fee) also carry the disposition
+    details; a Fee is a disposition for no proceeds whose outlay is its
+    CAD value, so its loss is the ACB of the units given up plus that
+    outlay, like any other line (gain = proceeds - ACB - outlays).
+
+    With an AcquisitionIndex, losses that are superficial under the 30-day
+    rule are denied: the gain is adjusted, the denied amount is reported in
+    denied_loss and added back to the token's ACB.
+
+    Arithmetic runs in LEDGER_CONTEXT and is not rounded; callers quantize.
+    """
+    dec = to_decimal
+    dec_float = decimal.Decimal
+
+    def dispose(state, units):
+        # Remove units at the current average cost; returns the ACB removed.
+        cost_basis = ZERO
+        if state.units_held > 0:
+            cost_basis = state.total_acb / state.units_held * units
+            state.total_acb = max(ZERO, state.total_acb - cost_basis)
+        state.units_held = max(ZERO, state.units_held - units)
+        return cost_basis
+
+    def apply(row):
+        (trans_id, date, token, action, token_amt, cad_amt,
+         sent_token, sent_amt, sent_cad, fee_cad, gas_cad) = row
+
+        # Nearly every stored amount is a float, so convert those inline and
+        # leave the rest (None, zero, int, text) to to_decimal.
+        token_amt = dec_float(repr(token_amt)) if token_amt.__class__ is float and token_amt else dec(token_amt)
+        cad_amt = dec_float(repr(cad_amt)) if cad_amt.__class__ is float and cad_amt else dec(cad_amt)
+        fee_cad = dec_float(repr(fee_cad)) if fee_cad.__class__ is float and fee_cad else dec(fee_cad)
+        gas_cad = dec(gas_cad) if gas_cad else ZERO
+        realized_gain = None
+        disposed_token = None
+        disposed_units = proceeds = cost_basis = outlays = denied_loss = ZERO
+        state = acb_state[token]
+
+        if gas_cad > 0:
+            acb_state["GAS_FEES"].total_acb -= gas_cad
+
+        if action == "Buy" or action == "Reward":
+            state.total_acb += cad_amt + fee_cad if action == "Buy" else cad_amt
+            state.units_held += token_amt
+        elif action == "Sell":
+            cost_basis = dispose(state, token_amt) if state.units_held > 0 else ZERO
+            disposed_token, disposed_units, proceeds, outlays = token, token_amt, cad_amt, fee_cad
+            realized_gain = proceeds - outlays - cost_basis
+        elif action == "Trade":
+            sent_amt_dec = dec(sent_amt)
+            if sent_token and sent_amt_dec and sent_cad is not None:
+                sent_state = acb_state[sent_token]
+                cost_basis = dispose(sent_state, sent_amt_dec) if sent_state.units_held > 0 else ZERO
+                disposed_token, disposed_units, proceeds = sent_token, sent_amt_dec, dec(sent_cad)
+                realized_gain = proceeds - cost_basis
+            state.total_acb += cad_amt + fee_cad
+            state.units_held += token_amt
+        elif action == "Stake" or action == "Unstake":
+            acb_moved = dispose(state, token_amt)
+            sent_state = acb_state[sent_token]
+            sent_state.total_acb += acb_moved
+            sent_state.units_held += dec(sent_amt)
+        elif action == "Fee":
+            cost_basis = dispose(state, token_amt)
+            disposed_token, disposed_units, outlays = token, token_amt, cad_amt
+            realized_gain = -(cost_basis + outlays)
+
+        if acquisitions is not None and realized_gain is not None and realized_gain < 0:
+            fraction = acquisitions.denied_fraction(disposed_token, date, disposed_units)
+            if fraction > 0:
+                denied_loss = -realized_gain * fraction
+                realized_gain += denied_loss
+                acb_state[disposed_token].total_acb += denied_loss
+
+        units = state.units_held
+        return LedgerStep(trans_id, date, action, token, realized_gain, units,
+                          state.total_acb / units if units > 0 else ZERO, disposed_token, disposed_units, proceeds,
+                          cost_basis, outlays, denied_loss, fee_cad, gas_cad, sent_token)
+
+    # One context for the whole replay. The consumer runs in it too between
+    # steps, which suits callers that total the yielded Decimals.
+    with decimal.localcontext(LEDGER_CONTEXT):
+        for row in rows:
+            yield apply(row)
+
+
+def load_acb_state(conn):
+    """Read persisted acb_state into a fresh replay state."""
+    acb_state = new_acb_state()
+    for token, total_acb, units_held in conn.execute("SELECT token, total_acb, units_held FROM acb_state"):
+        acb_state[token] = TokenState(to_decimal(total_acb), to_decimal(units_held))
+    return acb_state
+
+
+def closed_through(conn):
+    """Latest closed tax year, or None while every year is open."""
+    return conn.execute("SELECT MAX(year) FROM closed_years").fetchone()[0]
+
+
+def opening_acb_state(conn, year=None):
+    """Replay state carried forward from the latest closed tax year, or from year."""
+    acb_state = new_acb_state()
+    if year is None:
+        balances = conn.execute("SELECT token, total_acb, units_held FROM opening_balances")
+    else:
+        balances = conn.execute("SELECT token, total_acb, units_held FROM year_end_balances WHERE year = ?", (year,))
+    for token, total_acb, units_held in balances:
+        acb_state[token] = TokenState(to_decimal(total_acb), to_decimal(units_held))
+    return acb_state
+
+
+def replay_source(conn, through=None):
+    """Return (rows, acb_state, acquisitions) for replaying the ledger up to through.
+
+    Up to a date in an open year, only the live ledger is read, starting
+    from the carried-forward opening balances. Up to a date in a closed
+    year, the replay starts from the balances of the closed year before it
+    (or from nothing) and reads the archived rows after that. Either way
+    the rows stream off a cursor.
+    """
+    closed = closed_through(conn)
+    if closed is None or through is None or through > f"{closed:04d}-12-31":
+        rows = conn.execute(f"""
+            SELECT {LEDGER_COLUMNS}
+            FROM transactions
+            WHERE date <= ?
+            ORDER BY date, id
+        """, (through or "9999-12-31",))
+        return rows, opening_acb_state(conn), AcquisitionIndex(conn)
+    base = conn.execute("SELECT MAX(year) FROM closed_years WHERE year < ?", (int(through[:4]),)).fetchone()[0]
+    if base is None:
+        since, acb_state, base_sql = "", new_acb_state(), "NULL"
+    else:
+        since, acb_state, base_sql = f"{base:04d}-12-31", opening_acb_state(conn, base), str(int(base))
+    source = f"""(
+        SELECT {TRANSACTION_COLUMNS} FROM archived_transactions WHERE date > '{since}'
+        UNION ALL
+        SELECT {TRANSACTION_COLUMNS} FROM transactions
+    )"""
+    opening = f"(SELECT year, token, total_acb, units_held FROM year_end_balances WHERE year = {base_sql})"
+    rows = conn.execute(f"""
+        SELECT {LEDGER_COLUMNS} FROM {source}
+        WHERE date <= ?
+        ORDER BY date, id
+    """, (through,))
+    return rows, acb_state, AcquisitionIndex(conn, source, opening, base_sql)
+
+
+def close_tax_year(conn, year, today=None):
+    """Archive every live transaction up to the end of year; returns the rows moved.
+
+    A year can only be closed once the superficial-loss window after 31
+    December has passed, since purchases in that window can still deny a
+    loss realized at year end.
+
+    The closing per-token balances are recorded in year_end_balances and
+    seed every later replay of the live ledger. They come from a replay
+    whose acquisition index still sees the following year, so superficial
+    losses across the boundary are settled exactly as before. Runs in the
+    caller's transaction; acb_state must be recomputed before committing.
+    """
+    year = int(year)
+    latest = closed_through(conn)
+    if latest is not None and year <= latest:
+        raise ValueError(f"{year} is already closed")
+    window_end = date_cls(year, 12, 31) + timedelta(days=SUPERFICIAL_LOSS_DAYS)
+    if (today or date_cls.today()) <= window_end:
+        raise ValueError(f"{year} cannot be closed before {window_end + timedelta(days=1)}, "
+                         f"when its {SUPERFICIAL_LOSS_DAYS}-day superficial loss window has passed")
+    year_end = f"{year:04d}-12-31"
+
+    rows, acb_state, acquisitions = replay_source(conn, year_end)
+    steps = [
+        (step.trans_id, step.realized_gain, step.units_after, step.acb_per_unit_after,
+         step.denied_loss or None)
+        for step in replay_ledger(rows, acb_state, acquisitions)
+    ]
+    conn.executemany(
+        "INSERT INTO year_end_balances (year, token, total_acb, units_held) VALUES (?, ?, ?, ?)",
+        [(year, token, state.total_acb, state.units_held) for token, state in acb_state.items()
+         if token is not None and (state.total_acb or state.units_held)]
+    )
+    conn.executemany(
+        "INSERT OR REPLACE INTO archived_transaction_acb"
+        " (transaction_id, realized_gain, units_after, acb_per_unit_after, denied_loss)"
+        " VALUES (?, ?, ?, ?, ?)",
+        steps
+    )
+    conn.execute(f"""
+        INSERT INTO archived_transactions ({TRANSACTION_COLUMNS})
+        SELECT {TRANSACTION_COLUMNS} FROM transactions WHERE date <= ?
+    """, (year_end,))
+    conn.execute("DELETE FROM transaction_acb WHERE transaction_id IN (SELECT id FROM transactions WHERE date <= ?)",
+                 (year_end,))
+    archived = conn.execute("DELETE FROM transactions WHERE date <= ?", (year_end,)).rowcount
+    conn.execute("INSERT INTO closed_years (year, closed_at, archived_rows) VALUES (?, ?, ?)",
+                 (year, datetime.now().isoformat(timespec="seconds"), archived))
+    return archived
+
+
+def reopen_tax_year(conn, year):
+    """Move the latest closed year's rows back into the live ledger; returns the rows moved.
+
+    Only the latest closed year can be reopened, so the opening balances
+    of the live ledger always match the archive. Runs in the caller's
+    transaction; acb_state must be recomputed before committing.
+    """
+    latest = closed_through(conn)
+    if latest is None:
+        raise ValueError("No tax year is closed")
+    if int(year) != latest:
+        raise ValueError(f"Only the latest closed year ({latest}) can be reopened")
+    previous = conn.execute("SELECT MAX(year) FROM closed_years WHERE year < ?", (latest,)).fetchone()[0]
+    since = f"{previous:04d}-12-31" if previous is not None else ""
+
+    conn.execute("DELETE FROM closed_years WHERE year = ?", (latest,))
+    conn.execute("DELETE FROM year_end_balances WHERE year = ?", (latest,))
+    conn.execute(f"""
+        INSERT INTO transactions ({TRANSACTION_COLUMNS})
+        SELECT {TRANSACTION_COLUMNS} FROM archived_transactions WHERE date > ?
+    """, (since,))
+    conn.execute("""
+        DELETE FROM archived_transaction_acb
+        WHERE transaction_id IN (SELECT id FROM archived_transactions WHERE date > ?)
+    """, (since,))
+    return conn.execute("DELETE FROM archived_transactions WHERE date > ?", (since,)).rowcount
+
+
+def parse_sim_order(text):
+    """Parse a what-if order into a ledger row tuple.
+
+    Accepted forms (prices are CAD per unit of the first token):
+        SELL 1.5 BTC @ 60000 [FEE 10]
+        BUY 2 ETH @ 3500 [FEE 5]
+        TRADE 2 ETH FOR 0.1 BTC @ 3500 [FEE 5]
+    """
+    words = text.replace("@", " @ ").split()
+    upper = [w.upper() for w in words]
+    fee = 0.0
+    if len(upper) >= 2 and upper[-2] == "FEE":
+        fee = float(words[-1])
+        words, upper = words[:-2], upper[:-2]
+    date = datetime.now().strftime("%Y-%m-%d")
+
+    if len(upper) == 5 and upper[0] in ("SELL", "BUY") and upper[3] == "@":
+        units, token, price = float(words[1]), words[2], float(words[4])
+        if units <= 0 or price < 0:
+            raise ValueError("Units must be positive and price non-negative")
+        action = upper[0].title()
+        return (None, date, token, action, units, units * price, None, None, None, fee, 0.0)
+    if len(upper) == 8 and upper[0] == "TRADE" and upper[3] == "FOR" and upper[6] == "@":
+        sent_units, sent_token = float(words[1]), words[2]
+        units, token, price = float(words[4]), words[5], float(words[7])
+        if sent_units <= 0 or units <= 0 or price < 0:
+            raise ValueError("Units must be positive and price non-negative")
+        value = sent_units * price
+        return (None, date, token, "Trade", units, value, sent_token, sent_units, value, fee, 0.0)
+    raise ValueError(f"Unrecognized order: {text!r}")
+
+
+SimResult = namedtuple("SimResult", "order realized_gain proceeds cost_basis units_left acb_per_unit_after warning")
+
+
+def simulate_orders(acb_state, orders):
+    """Apply hypothetical orders, in sequence, to an in-memory copy of acb_state.
+
+    Each order costs constant time; the real ledger is never touched.
+    Superficial-loss rules are not applied to hypothetical orders.
+    """
+    state = new_acb_state()
+    for token, values in acb_state.items():
+        state[token] = TokenState(values.total_acb, values.units_held)
+    by_upper = {token.upper(): token for token in state}
+
+    results = []
+    for text in orders:
+        row = parse_sim_order(text)
+        token = by_upper.setdefault(row[2].upper(), row[2].upper())
+        sent_token = by_upper.setdefault(row[6].upper(), row[6].upper()) if row[6] else None
+        row = row[:2] + (token,) + row[3:6] + (sent_token,) + row[7:]
+
+        warning = ""
+        disposed, units = (sent_token, row[7]) if sent_token else (token, row[4])
+        if row[3] != "Buy" and state[disposed].units_held < to_decimal(units):
+            warning = f"Exceeds holdings ({float(state[disposed].units_held):.8f} {disposed} held)"
+
+        step = next(replay_ledger([row], state))
+        after = state[disposed]
+        results.append(SimResult(text, step.realized_gain, step.proceeds, step.cost_basis,
+                                 after.units_held, after.acb_per_unit(), warning))
+    return results
+
+
+IntegrityIssue = namedtuple("IntegrityIssue", "trans_id date token issue")
+
+
+def check_ledger_integrity(conn):
+    """Find every row that drives a token's running balance negative.
+
+    The running balance per token is a window sum over the signed legs in
+    (token, date, id) order, so SQLite does the work in one scan. Stakes
+    and unstakes of receipt tokens missing from receipt_tokens are reported too.
+    """
+    issues = []
+    cur = conn.execute(f"""
+        SELECT id, date, leg_token, action, delta, balance
+        FROM (
+            SELECT id, date, leg_token, action, delta,
+                   SUM(delta) OVER (PARTITION BY leg_token ORDER BY date, id
+                                    ROWS UNBOUNDED PRECEDING) AS balance
+            FROM ({LEDGER_LEGS_SQL})
+        )
+        WHERE delta < 0 AND balance < -1e-9
+        ORDER BY date, id
+    """)
+    for trans_id, date, token, action, delta, balance in cur:
+        held = balance - delta
+        if action == "Stake" and held <= 1e-9:
+            issue = f"Stake of {token} never held"
+        else:
+            issue = f"{action} of {-delta:.8f} {token} with {max(held, 0.0):.8f} held (short {-balance:.8f})"
+        issues.append(IntegrityIssue(trans_id, date, token, issue))
+
+    cur = conn.execute(f"""
+        SELECT id, date, action, {RECEIPT_TOKEN_SQL} AS receipt
+        FROM transactions t
+        WHERE action IN ('Stake', 'Unstake')
+          AND NOT EXISTS (SELECT 1 FROM receipt_tokens r WHERE r.receipt = {RECEIPT_TOKEN_SQL})
+        ORDER BY date, id
+    """)
+    for trans_id, date, action, receipt in cur:
+        issues.append(IntegrityIssue(trans_id, date, receipt, f"{action} of unmapped receipt token '{receipt}'"))
+    issues.sort(key=lambda i: (i.date, i.trans_id))
+    return issues
+
+
+AcbDrift = namedtuple("AcbDrift", "table key stored expected")
+
+ACB_STATE_FIELDS = ("total_acb", "units_held")
+TRANSACTION_ACB_FIELDS = ("realized_gain", "units_after", "acb_per_unit_after", "denied_loss")
+
+
+def _values_drift(stored, expected):
+    # Stored values went through REAL columns, so compare with a tolerance.
+    for s, e in zip(stored, expected):
+        if s is None or e is None:
+            if (s is None) != (e is None):
+                return True
+        elif not math.isclose(float(s), float(e), rel_tol=1e-9, abs_tol=1e-9):
+            return True
+    return False
+
+
+def verify_acb_state(conn):
+    """Replay the ledger and diff the result against acb_state and transaction_acb.
+
+    Everything is read inside one read transaction, so on a WAL database the
+    replay sees a single consistent snapshot and never blocks writers. The
+    replay streams alongside the stored per-row results, so memory does not
+    grow with the ledger. Between batches of rows the thread sleeps briefly
+    to give way to the UI thread.
+
+    Returns (version, drifts): the ledger_version that was checked and an
+    AcbDrift per difference. A missing row has stored None; a stale row that
+    the replay no longer produces has expected None.
+    """
+    drifts = []
+    conn.execute("BEGIN")
+    try:
+        version = ledger_version(conn)
+        row = conn.execute("SELECT value FROM ledger_meta WHERE key = 'acb_version'").fetchone()
+        if not row or row[0] != version:
+            drifts.append(AcbDrift("ledger_meta", "acb_version", row[0] if row else None, version))
+
+        acquisitions = AcquisitionIndex(conn)
+        cur = conn.execute(f"""
+            SELECT {", ".join("t." + c.strip() for c in LEDGER_COLUMNS.split(","))},
+                   a.transaction_id, {", ".join("a." + f for f in TRANSACTION_ACB_FIELDS)}
+            FROM transactions t
+            LEFT JOIN transaction_acb a ON a.transaction_id = t.id
+            ORDER BY t.date, t.id
+        """)
+        stored_steps = deque()
+
+        def ledger_rows():
+            for i, row in enumerate(cur, 1):
+                stored_steps.append(row[11:])
+                yield row[:11]
+                if i % VERIFY_YIELD_ROWS == 0:
+                    time.sleep(0.001)
+
+        acb_state = opening_acb_state(conn)
+        for step in replay_ledger(ledger_rows(), acb_state, acquisitions):
+            stored_id, *stored = stored_steps.popleft()
+            expected = (step.realized_gain, step.units_after, step.acb_per_unit_after, step.denied_loss or None)
+            if stored_id is None:
+                drifts.append(AcbDrift("transaction_acb", step.trans_id, None, expected))
+            elif _values_drift(stored, expected):
+                drifts.append(AcbDrift("transaction_acb", step.trans_id, tuple(stored), expected))
+        for trans_id, *stored in conn.execute(f"""
+            SELECT transaction_id, {", ".join(TRANSACTION_ACB_FIELDS)}
+            FROM transaction_acb
+            WHERE transaction_id NOT IN (SELECT id FROM transactions)
+        """):
+            drifts.append(AcbDrift("transaction_acb", trans_id, tuple(stored), None))
+
+        stored_state = {token: (total_acb, units_held) for token, total_acb, units_held
+                        in conn.execute("SELECT token, total_acb, units_held FROM acb_state")}
+        for token, state in acb_state.items():
+            expected = (state.total_acb, state.units_held)
+            stored = stored_state.pop(token, None)
+            if stored is None or _values_drift(stored, expected):
+                drifts.append(AcbDrift("acb_state", token, stored, expected))
+        for token, stored in stored_state.items():
+            drifts.append(AcbDrift("acb_state", token, stored, None))
+    finally:
+        conn.rollback()
+    return version, drifts
+
+
+def repair_acb_state(conn, version, drifts):
+    """Apply the expected values from verify_acb_state in one short write transaction.
+
+    Returns False without writing if the ledger has changed since version,
+    since the drifts no longer describe it; the caller should verify again.
+    A repair bumps ledger_version, with acb_version kept level, so readers
+    that cache on the version see the repaired values.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if ledger_version(conn) != version:
+            conn.rollback()
+            return False
+        for drift in drifts:
+            if drift.table == "ledger_meta":
+                conn.execute("INSERT OR REPLACE INTO ledger_meta (key, value) VALUES ('acb_version', ?)",
+                             (drift.expected,))
+            elif drift.table == "acb_state":
+                if drift.expected is None:
+                    conn.execute("DELETE FROM acb_state WHERE token IS ?", (drift.key,))
+                else:
+                    conn.execute("INSERT OR REPLACE INTO acb_state (token, total_acb, units_held) VALUES (?, ?, ?)",
+                                 (drift.key,) + drift.expected)
+            elif drift.expected is None:
+                conn.execute("DELETE FROM transaction_acb WHERE transaction_id = ?", (drift.key,))
+            else:
+                conn.execute(f"INSERT OR REPLACE INTO transaction_acb (transaction_id, {', '.join(TRANSACTION_ACB_FIELDS)})"
+                             " VALUES (?, ?, ?, ?, ?)", (drift.key,) + drift.expected)
+        conn.execute("UPDATE ledger_meta SET value = ? WHERE key IN ('ledger_version', 'acb_version')",
+                     (version + 1,))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return True
+
+
+def describe_drift(drift):
+    fields = ACB_STATE_FIELDS if drift.table == "acb_state" else TRANSACTION_ACB_FIELDS
+    if drift.table == "ledger_meta":
+        return f"acb_version is {drift.stored}, ledger is at {drift.expected}"
+    if drift.stored is None:
+        return f"{drift.table} {drift.key}: missing"
+    if drift.expected is None:
+        return f"{drift.table} {drift.key}: stale row"
+    changed = [f"{name} {float(s or 0):.8f} != {float(e or 0):.8f}"
+               for name, s, e in zip(fields, drift.stored, drift.expected)
+               if (s is None) != (e is None) or (s is not None and _values_drift((s,), (e,)))]
+    return f"{drift.table} {drift.key}: " + ", ".join(changed)
+
+
+def compute_report_data(rows, acb_state, acquisitions=None):
+    """Summarize a replay of LEDGER_COLUMNS rows in (date, id) order for the report.
+
+    Totals are exact Decimals accumulated in LEDGER_CONTEXT and quantized
+    once on the way out, so they agree with acb_state and Schedule 3.
+    """
+    total_gas_loss = ZERO
+    total_exchange_fees = ZERO
+    action_counts = defaultdict(int)
+
+    token_gains = defaultdict(decimal.Decimal)
+    token_gas = defaultdict(decimal.Decimal)
+    token_denied = defaultdict(decimal.Decimal)
+
+    # replay_ledger keeps LEDGER_CONTEXT active while this loop runs.
+    for (_, _, action, token, realized_gain, _, _, disposed_token, _, _, _, _,
+         denied_loss, fee_cad, gas_cad, _) in replay_ledger(rows, acb_state, acquisitions):
+        action_counts[action] += 1
+        if fee_cad:
+            total_exchange_fees += fee_cad
+        if gas_cad:
+            total_gas_loss += gas_cad
+            if gas_cad > 0:
+                token_gas[token] += gas_cad
+        if realized_gain is not None:
+            token_gains[disposed_token] += realized_gain
+        if denied_loss:
+            token_denied[disposed_token] += denied_loss
+    total_realized_gain = functools.reduce(LEDGER_CONTEXT.add, token_gains.values(), ZERO)
+
+    def cents(totals):
+        return {token: value.quantize(CENT) for token, value in totals.items()}
+
+    current_holdings = {}
+    for token, state in acb_state.items():
+        if state.units_held > 0:
+            current_holdings[token] = {
+                "units": state.units_held.quantize(UNIT_QUANTUM),
+                "total_acb": state.total_acb.quantize(CENT),
+                "acb_per_unit": state.acb_per_unit().quantize(RATE_QUANTUM)
+            }
+
+    return {
+        "total_realized_gain": total_realized_gain.quantize(CENT),
+        "total_gas_loss": total_gas_loss.quantize(CENT),
+        "total_exchange_fees": total_exchange_fees.quantize(CENT),
+        "net_pnl": (total_realized_gain - total_gas_loss).quantize(CENT),
+        "action_counts": dict(action_counts),
+        "token_gains": cents(token_gains),
+        "token_gas": cents(token_gas),
+        "token_denied": cents(token_denied),
+        "current_holdings": current_holdings
+    }
+
+
+def format_report(data):
+    """Render report data as the text shown in the Reports tab."""
+    report = "📊 Ledge Tax & Portfolio Summary\n"
+    report += "=" * 40 + "\n\n"
+
+    if data.get('closed_through') is not None:
+        report += f"🔒 Tax years through {data['closed_through']} are closed; figures below start from their closing balances.\n\n"
+
+    report += "💰 Financial Summary\n"
+    report += f"Total Realized Capital Gains: ${data['total_realized_gain']:.2f}\n"
+    report += f"Total Gas Fees (Capital Losses): -${data['total_gas_loss']:.2f}\n"
+    report += f"Total Exchange Fees Paid: ${data['total_exchange_fees']:.2f}\n"
+    report += f"Net PnL (Gains - Gas Losses): ${data['net_pnl']:.2f}\n\n"
+
+    report += "📈 Activity Summary\n"
+    for action, count in sorted(data['action_counts'].items()):
+        report += f"{action}: {count} transaction(s)\n"
+    report += "\n"
+
+    if data['token_gains']:
+        report += "🔖 Realized Gains by Token\n"
+        for token, gain in sorted(data['token_gains'].items(), key=lambda x: -x[1]):
+            report += f"{token}: ${gain:.2f}\n"
+        report += "\n"
+
+    if data['token_denied']:
+        report += "🚫 Superficial Losses Denied (added to ACB)\n"
+        for token, denied in sorted(data['token_denied'].items(), key=lambda x: -x[1]):
+            report += f"{token}: ${denied:.2f}\n"
+        report += "\n"
+
+    if data['current_holdings']:
+        report += "💼 Current Holdings\n"
+        for token, h in sorted(data['current_holdings'].items()):
+            report += f"{token}: {h['units']:.8f} units @ ${h['acb_per_unit']:.4f}/unit (ACB: ${h['total_acb']:.2f})\n"
+        report += "\n"
+
+    if data['token_gas']:
+        report += "⛽ Gas Fees by Token\n"
+        for token, gas in sorted(data['token_gas'].items(), key=lambda x: -x[1]):
+            report += f"{token}: -${gas:.2f}\n"
+        report += "\n"
+
+    if data.get('staking_positions'):
+        report += "🥩 Open Staking Positions\n"
+        for p in data['staking_positions']:
+            report += (f"{p['receipt']} (stake #{p['stake_id']}, {p['date']}): {p['receipt_units']:.8f} "
+                       f"for {p['original_units']:.8f} {p['original']}, basis ${p['basis_cad']:.2f}")
+            if p['value_cad'] is None:
+                report += ", no price\n"
+            else:
+                report += f", value ${p['value_cad']:.2f}, accrued ${p['accrued_cad']:.2f}\n"
+            if p.get('unstakes'):
+                report += "  already unstaked: " + ", ".join(
+                    f"#{unstake_id} ({units:.8f})" for unstake_id, units in p['unstakes']) + "\n"
+        report += "\n"
+
+    report += "ℹ️ Note: Unrealized gains not included in PnL.\n"
+    report += "ℹ️ Use 'Export CSV' for full audit trail."
+    return report
+
+
+SNAPSHOT_FORMAT = "ledge-columnar"
+SNAPSHOT_BATCH_SIZE = 10000
+
+# (column, kind) per table. Kinds: int -> int64, float -> float64 with NaN
+# for NULL, date -> int32 day ordinal, dict -> int32 codes into a value list
+# kept in the manifest (-1 for NULL), text -> int64 offsets plus UTF-8 data.
+SNAPSHOT_TABLES = {
+    "transactions": ("date, id", [
+        ("id", "int"), ("date", "date"), ("token", "dict"), ("action", "dict"),
+        ("token_amount", "float"), ("cad_amount", "float"),
+        ("sent_token", "dict"), ("sent_amount", "float"), ("sent_cad", "float"),
+        ("fee_cad", "float"), ("gas_cad", "float"), ("notes", "text"),
+        ("ext_tx_id", "text"), ("native_currency", "dict"), ("fx_rate", "float"),
+    ]),
+    "acb_state": ("token", [
+        ("token", "dict"), ("total_acb", "float"), ("units_held", "float"),
+    ]),
+    "opening_balances": ("token", [
+        ("year", "int"), ("token", "dict"), ("total_acb", "float"), ("units_held", "float"),
+    ]),
+    "closing_acquisitions": ("date, id", [
+        ("id", "int"), ("date", "date"), ("token", "dict"), ("token_amount", "float"),
+    ]),
 }
-ORIGINAL_TO_RECEIPT_MAP = {v: k for k, v in RECEIPT_TO_ORIGINAL_MAP.items()}
+SNAPSHOT_TYPECODES = {"int": "q", "float": "d", "date": "i", "dict": "i", "text": "q"}
+
+
+def export_snapshot(conn, directory):
+    """Write the SNAPSHOT_TABLES as one typed array file per column.
+
+    Everything is read in one read transaction, ledger_version first.
+    Rows are streamed in batches, so memory stays flat. Arrays are in
+    native byte order (recorded in manifest.json) so they can be
+    memory-mapped and read without copying. Returns the manifest.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    # One read transaction, so the columns and the ledger_version stamped on
+    # them come from the same state of the database even with writers active.
+    conn.execute("BEGIN")
+    try:
+        manifest = {
+            "format": SNAPSHOT_FORMAT,
+            "version": 1,
+            "byteorder": sys.byteorder,
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "ledger_version": ledger_version(conn),
+            "closed_through": closed_through(conn),
+            "tables": {},
+        }
+        for table, (order, columns) in SNAPSHOT_TABLES.items():
+            names = [name for name, _ in columns]
+            files = {}
+            dictionaries = {}
+            text_offsets = {}
+            meta = {}
+            try:
+                for name, kind in columns:
+                    meta[name] = {"kind": kind, "typecode": SNAPSHOT_TYPECODES[kind], "file": f"{table}.{name}.bin"}
+                    files[name] = open(directory / meta[name]["file"], 'wb')
+                    if kind == "dict":
+                        dictionaries[name] = {}
+                    elif kind == "text":
+                        meta[name]["data"] = f"{table}.{name}.txt"
+                        files[name + ".data"] = open(directory / meta[name]["data"], 'wb')
+                        text_offsets[name] = 0
+                        array('q', [0]).tofile(files[name])
+
+                count = 0
+                cur = conn.execute(f"SELECT {', '.join(names)} FROM {table} ORDER BY {order}")
+                while True:
+                    rows = cur.fetchmany(SNAPSHOT_BATCH_SIZE)
+                    if not rows:
+                        break
+                    count += len(rows)
+                    for i, (name, kind) in enumerate(columns):
+                        values = [row[i] for row in rows]
+                        if kind == "int":
+                            chunk = array('q', values)
+                        elif kind == "float":
+                            chunk = array('d', (math.nan if v is None else float(v) for v in values))
+                        elif kind == "date":
+                            chunk = array('i', (date_cls.fromisoformat(v).toordinal() for v in values))
+                        elif kind == "dict":
+                            codes = dictionaries[name]
+                            chunk = array('i', (-1 if v is None else codes.setdefault(v, len(codes)) for v in values))
+                        else:
+                            encoded = [(v or "").encode('utf-8') for v in values]
+                            offsets = array('q')
+                            position = text_offsets[name]
+                            for data in encoded:
+                                position += len(data)
+                                offsets.append(position)
+                            text_offsets[name] = position
+                            files[name + ".data"].write(b"".join(encoded))
+                            chunk = offsets
+                        chunk.tofile(files[name])
+            finally:
+                for f in files.values():
+                    f.close()
+
+            for name, codes in dictionaries.items():
+                meta[name]["values"] = list(codes)
+            manifest["tables"][table] = {"rows": count, "order": order, "columns": meta}
+    finally:
+        conn.rollback()
+
+    (directory / "manifest.json").write_text(json.dumps(manifest, indent=2), encoding='utf-8')
+    return manifest
+
+
+class Snapshot:
+    """Read-only, memory-mapped view of a columnar snapshot.
+
+    Each file is mapped once, on first use, and stays mapped until close().
+    Use it as a context manager so the maps and their descriptors are
+    released.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.manifest = json.loads((self.directory / "manifest.json").read_text(encoding='utf-8'))
+        if self.manifest.get("format") != SNAPSHOT_FORMAT:
+            raise ValueError(f"{directory} is not a Ledge snapshot")
+        if self.manifest.get("byteorder") != sys.byteorder:
+            raise ValueError("Snapshot was written on a machine with a different byte order")
+        self._maps = []
+        self._views = {}
+
+    def close(self):
+        # Views must be released before the maps they export can be closed.
+        for view, base in self._views.values():
+            view.release()
+            if base is not None:
+                base.release()
+        self._views.clear()
+        for mapped in self._maps:
+            mapped.close()
+        self._maps.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def rows(self, table):
+        return self.manifest["tables"][table]["rows"]
+
+    def _view(self, filename, typecode):
+        cached = self._views.get((filename, typecode))
+        if cached is not None:
+            return cached[0]
+        path = self.directory / filename
+        if path.stat().st_size == 0:
+            base, view = None, memoryview(b"").cast(typecode)
+        else:
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps.append(mapped)
+            base = memoryview(mapped)
+            view = base.cast(typecode)
+        self._views[filename, typecode] = (view, base)
+        return view
+
+    def column(self, table, name):
+        """Zero-copy memoryview of a column's array (codes for dict, offsets for text)."""
+        meta = self.manifest["tables"][table]["columns"][name]
+        return self._view(meta["file"], meta["typecode"])
+
+    def values(self, table, name):
+        """Decoded values of a dict column's codes, or None."""
+        return self.manifest["tables"][table]["columns"][name].get("values")
+
+    def text(self, table, name, index):
+        meta = self.manifest["tables"][table]["columns"][name]
+        offsets = self.column(table, name)
+        data = self._view(meta["data"], "B")
+        return bytes(data[offsets[index]:offsets[index + 1]]).decode('utf-8')
+
+    def opening_balances(self):
+        """Yield (token, date, total_acb, units_held) carried in from the last closed year."""
+        if "opening_balances" not in self.manifest["tables"]:
+            return
+        table = "opening_balances"
+        years = self.column(table, "year")
+        codes, values = self.column(table, "token"), self.values(table, "token")
+        total_acb = self.column(table, "total_acb")
+        units_held = self.column(table, "units_held")
+        for i in range(len(years)):
+            yield values[codes[i]], f"{years[i]:04d}-12-31", total_acb[i], units_held[i]
+
+    def closing_acquisitions(self):
+        """Yield (token, date, units) acquired late in the last closed year, in date order."""
+        if "closing_acquisitions" not in self.manifest["tables"]:
+            return
+        table = "closing_acquisitions"
+        days = self.column(table, "date")
+        codes, values = self.column(table, "token"), self.values(table, "token")
+        units = self.column(table, "token_amount")
+        for i in range(len(days)):
+            yield values[codes[i]], date_cls.fromordinal(days[i]).isoformat(), units[i]
+
+    def iter_ledger_rows(self):
+        """Yield transactions as LEDGER_COLUMNS tuples in (date, id) order."""
+        table = "transactions"
+        ids = self.column(table, "id")
+        days = self.column(table, "date")
+        columns = {}
+        for name in ("token", "action", "sent_token"):
+            values = self.values(table, name)
+            columns[name] = (self.column(table, name), values)
+        floats = {name: self.column(table, name)
+                  for name in ("token_amount", "cad_amount", "sent_amount", "sent_cad", "fee_cad", "gas_cad")}
+        dates = {}
+
+        def decode(name, i):
+            codes, values = columns[name]
+            code = codes[i]
+            return None if code < 0 else values[code]
+
+        def number(name, i):
+            value = floats[name][i]
+            return None if value != value else value
+
+        for i in range(len(ids)):
+            day = days[i]
+            date = dates.get(day)
+            if date is None:
+                date = dates[day] = date_cls.fromordinal(day).isoformat()
+            yield (ids[i], date, decode("token", i), decode("action", i),
+                   floats["token_amount"][i], floats["cad_amount"][i],
+                   decode("sent_token", i), number("sent_amount", i), number("sent_cad", i),
+                   number("fee_cad", i), number("gas_cad", i))
+
+
+SCHEDULE3_HEADER = [
+    "Date", "Description", "Units", "Proceeds (CAD)", "ACB (CAD)", "Outlays (CAD)", "Gain/Loss (CAD)",
+    "Superficial Loss Denied (CAD)"
+]
+
+
+def iter_schedule3(conn, year):
+    """Stream Schedule 3 disposition lines for one tax year.
+
+    Replays the ledger up to the end of the year straight off the cursor,
+    so memory stays constant in the number of rows apart from the compact
+    acquisition index used for superficial-loss checks. This holds for a
+    closed year too, which replays the archive from the closed year before it.
+    """
+    year_prefix = f"{int(year):04d}-"
+    rows, acb_state, acquisitions = replay_source(conn, f"{int(year):04d}-12-31")
+    for step in replay_ledger(rows, acb_state, acquisitions):
+        if step.disposed_token is None or not step.date.startswith(year_prefix):
+            continue
+        units = step.disposed_units.quantize(UNIT_QUANTUM)
+        yield (
+            step.date,
+            f"{units.normalize():f} {step.disposed_token} ({step.action})",
+            units,
+            step.proceeds.quantize(CENT),
+            step.cost_basis.quantize(CENT),
+            step.outlays.quantize(CENT),
+            step.realized_gain.quantize(CENT),
+            step.denied_loss.quantize(CENT),
+        )
+
+
+def export_schedule3_csv(conn, year, path):
+    """Write the Schedule 3 lines for a tax year to CSV. Returns the line count."""
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(SCHEDULE3_HEADER)
+        for line in iter_schedule3(conn, year):
+            writer.writerow(line)
+            count += 1
+    return count
+
+
+class PriceStore:
+    """Local daily CAD prices, one sorted binary file per token.
+
+    Each file is a run of fixed-width (day ordinal, price) records sorted by
+    day. Files are memory-mapped on first lookup, so nothing is read at
+    startup and a lookup is a binary search over the mapped records.
+    """
+
+    RECORD = struct.Struct('<id')
+    DATE_COLUMNS = ("date", "time", "timestamp", "day")
+    PRICE_COLUMNS = ("close", "price", "cad", "close_cad", "price_cad")
+    TOKEN_COLUMNS = ("token", "symbol", "asset")
+
+    def __init__(self, directory=PRICE_DIR):
+        self.directory = Path(directory)
+        self._maps = {}
+
+    def path(self, token):
+        safe = "".join(ch for ch in token.upper() if ch.isalnum() or ch in "-_")
+        return self.directory / f"{safe}.bin"
+
+    def _mapped(self, token):
+        token = token.upper()
+        if token not in self._maps:
+            mapped = None
+            path = self.path(token)
+            if path.exists() and path.stat().st_size >= self.RECORD.size:
+                with open(path, 'rb') as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[token] = mapped
+        return self._maps[token]
+
+    def close(self, token=None):
+        tokens = [token.upper()] if token else list(self._maps)
+        for t in tokens:
+            mapped = self._maps.pop(t, None)
+            if mapped is not None:
+                mapped.close()
+
+    def price_on(self, token, date):
+        """CAD price of token on date, carrying the last known close forward."""
+        if not token:
+            return None
+        mapped = self._mapped(token)
+        if mapped is None:
+            return None
+        day = date_cls.fromisoformat(normalize_date(date)).toordinal()
+        record = self.RECORD
+        lo, hi = 0, len(mapped) // record.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if record.unpack_from(mapped, mid * record.size)[0] <= day:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return None
+        return record.unpack_from(mapped, (lo - 1) * record.size)[1]
+
+    def _read_all(self, token):
+        mapped = self._mapped(token)
+        if mapped is None:
+            return {}
+        return dict(self.RECORD.iter_unpack(mapped[:len(mapped) - len(mapped) % self.RECORD.size]))
+
+    def write(self, token, prices):
+        """Replace token's price file with the given {day ordinal: price} map."""
+        self.directory.mkdir(exist_ok=True)
+        data = bytearray()
+        for day in sorted(prices):
+            data += self.RECORD.pack(day, prices[day])
+        path = self.path(token)
+        tmp = path.with_suffix('.tmp')
+        tmp.write_bytes(bytes(data))
+        self.close(token)
+        os.replace(tmp, path)
+
+    def import_csv(self, path, token=None):
+        """Merge daily closes from a CSV into the store.
+
+        The CSV needs a date and a close/price column, plus a token/symbol
+        column unless token is given. Returns {token: rows imported}.
+        """
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            reader = csv.reader(f)
+            header = [h.strip().lower() for h in next(reader, [])]
+
+            def find(names):
+                return next((header.index(n) for n in names if n in header), None)
+
+            date_col = find(self.DATE_COLUMNS)
+            price_col = find(self.PRICE_COLUMNS)
+            token_col = find(self.TOKEN_COLUMNS)
+            if date_col is None or price_col is None:
+                raise ValueError("CSV needs a date column and a close or price column")
+            if token_col is None and not token:
+                raise ValueError("CSV has no token column; a token must be given")
+
+            updates = defaultdict(dict)
+            for line_no, row in enumerate(reader, start=2):
+                if not row:
+                    continue
+                try:
+                    day = date_cls.fromisoformat(normalize_date(row[date_col])).toordinal()
+                    price = float(row[price_col].replace(',', '').replace('$', ''))
+                except (ValueError, IndexError) as e:
+                    raise ValueError(f"Line {line_no}: {e}") from None
+                row_token = row[token_col].strip().upper() if token_col is not None else token.upper()
+                updates[row_token][day] = price
+
+        counts = {}
+        for row_token, prices in updates.items():
+            merged = self._read_all(row_token)
+            merged.update(prices)
+            self.write(row_token, merged)
+            counts[row_token] = len(prices)
+        return counts
+
+
+class Series:
+    """A time series of compact parallel arrays, x sorted ascending."""
+
+    def __init__(self):
+        self.xs = array('l')
+        self.ys = array('d')
+
+    def add(self, x, y):
+        # Several rows on one day collapse to the day's closing value.
+        if self.xs and self.xs[-1] == x:
+            self.ys[-1] = y
+        else:
+            self.xs.append(x)
+            self.ys.append(y)
+
+    def window(self, x_min, x_max):
+        """Index range of points within [x_min, x_max], widened by one on each side."""
+        lo = max(0, bisect.bisect_left(self.xs, x_min) - 1)
+        hi = min(len(self.xs), bisect.bisect_right(self.xs, x_max) + 1)
+        return lo, hi
+
+
+TOTAL_ACB_SERIES = "All tokens"
+
+
+def build_portfolio_series(conn):
+    """Replay the ledger, recording each token's units and ACB after every day.
+
+    Returns {token: {"units": Series, "acb": Series}}, plus a TOTAL_ACB_SERIES
+    entry holding the portfolio's total ACB.
+    """
+    series = defaultdict(lambda: {"units": Series(), "acb": Series()})
+    rows, acb_state, acquisitions = replay_source(conn)
+    last_acb = defaultdict(float)
+    total_acb = 0.0
+    closed = closed_through(conn)
+    if closed is not None:
+        day = date_cls(closed, 12, 31).toordinal()
+        for token, state in acb_state.items():
+            # GAS_FEES is a running tally in acb_state, not a holding; the
+            # replay below never charts it, so the seed must not either.
+            if token == "GAS_FEES":
+                continue
+            last_acb[token] = float(state.total_acb)
+            total_acb += last_acb[token]
+            series[token]["units"].add(day, float(state.units_held))
+            series[token]["acb"].add(day, last_acb[token])
+        series[TOTAL_ACB_SERIES]["acb"].add(day, total_acb)
+    for step in replay_ledger(rows, acb_state, acquisitions):
+        day = date_cls.fromisoformat(step.date).toordinal()
+        for token in {step.token, step.disposed_token, step.sent_token}:
+            if not token:
+                continue
+            state = acb_state[token]
+            acb = float(state.total_acb)
+            total_acb += acb - last_acb[token]
+            last_acb[token] = acb
+            series[token]["units"].add(day, float(state.units_held))
+            series[token]["acb"].add(day, acb)
+        series[TOTAL_ACB_SERIES]["acb"].add(day, total_acb)
+    return dict(series)
+
+
+def lttb(xs, ys, threshold):
+    """Largest-Triangle-Three-Buckets downsampling to about threshold points."""
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(zip(xs, ys))
+    sampled = [(xs[0], ys[0])]
+    bucket = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * bucket) + 1
+        end = int((i + 1) * bucket) + 1
+        next_end = min(int((i + 2) * bucket) + 1, n)
+        if end >= n:
+            end = n - 1
+        count = max(1, next_end - end)
+        avg_x = sum(xs[end:next_end]) / count if next_end > end else xs[-1]
+        avg_y = sum(ys[end:next_end]) / count if next_end > end else ys[-1]
+        ax, ay = xs[a], ys[a]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append((xs[best], ys[best]))
+        a = best
+    sampled.append((xs[-1], ys[-1]))
+    return sampled
+
+
+class TimeSeriesChart(tk.Canvas):
+    """Line chart on a plain Canvas with wheel zoom and drag pan.
+
+    Each redraw takes only the points in the visible date range and
+    downsamples them to the canvas width, so large series stay interactive.
+    """
+
+    MARGIN_LEFT = 80
+    MARGIN_RIGHT = 20
+    MARGIN_Y = 25
+
+    def __init__(self, parent, **kwargs):
+        super().__init__(parent, background="white", highlightthickness=0, **kwargs)
+        self.series = None
+        self.label = ""
+        self.view = None
+        self._drag_x = None
+        self.bind("<Configure>", lambda event: self.redraw())
+        self.bind("<ButtonPress-1>", self.on_press)
+        self.bind("<B1-Motion>", self.on_drag)
+        self.bind("<MouseWheel>", lambda event: self.zoom(event.x, 0.8 if event.delta > 0 else 1.25))
+        self.bind("<Button-4>", lambda event: self.zoom(event.x, 0.8))
+        self.bind("<Button-5>", lambda event: self.zoom(event.x, 1.25))
+
+    def set_series(self, series, label):
+        self.series = series
+        self.label = label
+        self.reset_view()
+
+    def reset_view(self):
+        if self.series is not None and self.series.xs:
+            self.view = (self.series.xs[0], max(self.series.xs[-1], self.series.xs[0] + 1))
+        else:
+            self.view = None
+        self.redraw()
+
+    def plot_width(self):
+        return max(1, self.winfo_width() - self.MARGIN_LEFT - self.MARGIN_RIGHT)
+
+    def x_at(self, px):
+        x_min, x_max = self.view
+        return x_min + (px - self.MARGIN_LEFT) / self.plot_width() * (x_max - x_min)
+
+    def zoom(self, px, factor):
+        if self.view is None:
+            return
+        x_min, x_max = self.view
+        center = self.x_at(px)
+        span = max(2, (x_max - x_min) * factor)
+        left = (center - x_min) / (x_max - x_min)
+        self.view = (center - span * left, center + span * (1 - left))
+        self.redraw()
+
+    def on_press(self, event):
+        self._drag_x = event.x
+
+    def on_drag(self, event):
+        if self.view is None or self._drag_x is None:
+            return
+        x_min, x_max = self.view
+        shift = (self._drag_x - event.x) / self.plot_width() * (x_max - x_min)
+        self._drag_x = event.x
+        self.view = (x_min + shift, x_max + shift)
+        self.redraw()
+
+    def redraw(self):
+        self.delete("all")
+        width, height = self.winfo_width(), self.winfo_height()
+        if self.view is None or width < 50 or height < 50:
+            self.create_text(width // 2, height // 2, text="No data", fill="gray")
+            return
+
+        x_min, x_max = self.view
+        lo, hi = self.series.window(x_min, x_max)
+        points = lttb(self.series.xs[lo:hi], self.series.ys[lo:hi], self.plot_width())
+        if not points:
+            self.create_text(width // 2, height // 2, text="No data in range", fill="gray")
+            return
+        y_values = [y for _, y in points]
+        y_min, y_max = min(y_values + [0.0]), max(y_values)
+        if y_max == y_min:
+            y_max = y_min + 1.0
+
+        left, right = self.MARGIN_LEFT, width - self.MARGIN_RIGHT
+        top, bottom = self.MARGIN_Y, height - self.MARGIN_Y
+
+        def px(x):
+            return left + (x - x_min) / (x_max - x_min) * (right - left)
+
+        def py(y):
+            return bottom - (y - y_min) / (y_max - y_min) * (bottom - top)
+
+        self.create_line(left, top, left, bottom, fill="gray")
+        self.create_line(left, bottom, right, bottom, fill="gray")
+        for y in (y_min, (y_min + y_max) / 2, y_max):
+            self.create_text(left - 5, py(y), text=f"{y:,.2f}", anchor=tk.E, font=("TkDefaultFont", 8))
+        for x, anchor in ((x_min, tk.NW), (x_max, tk.NE)):
+            day = date_cls.fromordinal(int(min(max(x, 1), date_cls.max.toordinal())))
+            self.create_text(px(x), bottom + 3, text=day.isoformat(), anchor=anchor, font=("TkDefaultFont", 8))
+        self.create_text(left + 5, top - 5, text=self.label, anchor=tk.SW)
+
+        coords = []
+        for x, y in points:
+            coords.extend((px(x), py(y)))
+        if len(coords) >= 4:
+            self.create_line(*coords, fill="steelblue", width=2)
+        else:
+            self.create_oval(coords[0] - 2, coords[1] - 2, coords[0] + 2, coords[1] + 2, fill="steelblue")
+
 
 class TransactionDialog(tk.Toplevel):
-    def __init__(self, parent, transaction=None):
+    def __init__(self, parent, transaction=None, prices=None, currencies=None, receipt_tokens=None):
         super().__init__(parent)
         self.title("Add Transaction" if not transaction else "Edit Transaction")
         self.result = None
+        self.entered = None
+        self.prices = prices
+        self.receipt_tokens = receipt_tokens or {}
+        self._auto_values = {}
         self.transient(parent)
         self.grab_set()
 
@@ -168,6 +2233,12 @@ class TransactionDialog(tk.Toplevel):
         tk.Entry(self, textvariable=self.gas_cad_var, width=12).grid(row=row, column=1, padx=5, pady=5)
         row += 1
         
+        tk.Label(self, text="Currency:").grid(row=row, column=0, sticky=tk.W, padx=5, pady=5)
+        self.currency_var = tk.StringVar(value=transaction[12] if transaction and len(transaction) > 12 and transaction[12] else "CAD")
+        ttk.Combobox(self, textvariable=self.currency_var, values=currencies or ["CAD"],
+                     width=10).grid(row=row, column=1, padx=5, pady=5)
+        row += 1
+
         tk.Label(self, text="Notes:").grid(row=row, column=0, sticky=tk.W, padx=5, pady=5)
         self.notes_var = tk.StringVar(value=transaction[6] if transaction else "")
         tk.Entry(self, textvariable=self.notes_var, width=30).grid(row=row, column=1, padx=5, pady=5)
@@ -182,9 +2253,38 @@ class TransactionDialog(tk.Toplevel):
         self.bind('<Escape>', lambda event: self.destroy())
         tk.Button(btn_frame, text="Cancel", command=self.destroy).pack(side=tk.LEFT, padx=5)
         
+        if self.prices is not None:
+            for var in (self.date_var, self.token_var, self.token_amt_var,
+                        self.sent_token_var, self.sent_amt_var):
+                var.trace_add("write", self.prefill_cad_values)
+
         self.on_action_change()
         self.wait_window(self)
 
+    def prefill_cad_values(self, *args):
+        """Fill CAD fields from local price history unless the user typed a value."""
+        if self.currency_var.get().strip().upper() != "CAD":
+            return
+        date = self.date_var.get().strip()
+        pairs = (
+            (self.token_var, self.token_amt_var, self.cad_amt_var),
+            (self.sent_token_var, self.sent_amt_var, self.sent_cad_var),
+        )
+        for token_var, amount_var, cad_var in pairs:
+            try:
+                amount = float(amount_var.get())
+                current = float(cad_var.get())
+                price = self.prices.price_on(token_var.get().strip(), date)
+            except (tk.TclError, ValueError):
+                continue
+            if price is None or amount <= 0:
+                continue
+            if current != 0 and current != self._auto_values.get(str(cad_var)):
+                continue
+            value = round(amount * price, 2)
+            self._auto_values[str(cad_var)] = value
+            cad_var.set(value)
+
     def on_action_change(self, event=None):
         action = self.action_var.get()
         token_text, amount_text, cad_text = self.label_map.get(action, ("Token:", "Amount:", "CAD Value:"))
@@ -302,10 +2402,12 @@ class TransactionDialog(tk.Toplevel):
                     return
 
             if action in ("Stake", "Unstake"):
-                if action == "Stake" and sent_token_val not in ORIGINAL_TO_RECEIPT_MAP.values():
-                    messagebox.showwarning("Unmapped Token", f"Receipt token '{sent_token_val}' not in standard mappings. Verify it's correct.")
-                if action == "Unstake" and token not in ORIGINAL_TO_RECEIPT_MAP.values():
-                    messagebox.showwarning("Unmapped Token", f"Receipt token '{token}' not in standard mappings. Verify it's correct.")
+                receipt, original = (sent_token_val, token) if action == "Stake" else (token, sent_token_val)
+                mapped = self.receipt_tokens.get((receipt or "").upper())
+                if mapped is None:
+                    messagebox.showwarning("Unmapped Token", f"Receipt token '{receipt}' not in receipt token registry. Verify it's correct.")
+                elif original and mapped[1].upper() != original.upper():
+                    messagebox.showwarning("Token Mismatch", f"Receipt token '{mapped[0]}' is registered for {mapped[1]}, not {original}.")
                 if sent_cad_val > 0 and cad_amount > 0:
                     diff_pct = abs(cad_amount - sent_cad_val) / max(cad_amount, sent_cad_val) * 100
                     if diff_pct > 1:
@@ -314,6 +2416,21 @@ class TransactionDialog(tk.Toplevel):
                         else:
                             messagebox.showwarning("Basis Mismatch", f"Input basis ${cad_amount:.2f} vs output basis ${sent_cad_val:.2f} differ by {diff_pct:.1f}%.")
 
+            # Amounts as typed, before conversion, so an edit can tell which were changed.
+            self.entered = (token_amount, cad_amount, sent_amount_val, sent_cad_val, fee_cad, gas_cad)
+            native_currency = self.currency_var.get().strip().upper() or "CAD"
+            rate = None
+            if native_currency != "CAD":
+                rate = fx_rate(native_currency, date_str)
+                if rate is None:
+                    messagebox.showerror("Exchange Rate",
+                        f"No {native_currency} exchange rate on or before {date_str}. Load Bank of Canada rates first.")
+                    return
+                cad_amount, sent_cad_val, fee_cad, gas_cad = convert_to_cad(
+                    rate, cad_amount, sent_cad_val, fee_cad, gas_cad)
+            else:
+                native_currency = None
+
             self.result = (
                 date_str,
                 token,
@@ -325,7 +2442,9 @@ class TransactionDialog(tk.Toplevel):
                 sent_amount_val,
                 sent_cad_val,
                 fee_cad,
-                gas_cad
+                gas_cad,
+                native_currency,
+                rate
             )
             self.destroy()
         except ValueError as e:
@@ -335,6 +2454,83 @@ class TransactionDialog(tk.Toplevel):
             import traceback
             traceback.print_exc()
 
+class ReceiptTokensDialog(tk.Toplevel):
+    """Edit the receipt_tokens registry used to validate Stake and Unstake rows."""
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.title("Receipt Tokens")
+        self.transient(parent)
+        self.grab_set()
+
+        self.tree = ttk.Treeview(self, columns=("Receipt", "Original"), show="headings", height=10)
+        for col in ("Receipt", "Original"):
+            self.tree.heading(col, text=col)
+            self.tree.column(col, width=120)
+        self.tree.grid(row=0, column=0, columnspan=4, padx=5, pady=5, sticky=tk.NSEW)
+        self.tree.bind("<<TreeviewSelect>>", self.on_select)
+
+        tk.Label(self, text="Receipt:").grid(row=1, column=0, sticky=tk.W, padx=5, pady=5)
+        self.receipt_var = tk.StringVar()
+        tk.Entry(self, textvariable=self.receipt_var, width=12).grid(row=1, column=1, padx=5, pady=5)
+        tk.Label(self, text="Original:").grid(row=1, column=2, sticky=tk.W, padx=5, pady=5)
+        self.original_var = tk.StringVar()
+        tk.Entry(self, textvariable=self.original_var, width=12).grid(row=1, column=3, padx=5, pady=5)
+
+        btn_frame = tk.Frame(self)
+        btn_frame.grid(row=2, column=0, columnspan=4, pady=10)
+        tk.Button(btn_frame, text="Save", command=self.save).pack(side=tk.LEFT, padx=5)
+        tk.Button(btn_frame, text="Remove", command=self.remove).pack(side=tk.LEFT, padx=5)
+        tk.Button(btn_frame, text="Close", command=self.destroy).pack(side=tk.LEFT, padx=5)
+        self.bind('<Escape>', lambda event: self.destroy())
+
+        self.refresh()
+        self.wait_window(self)
+
+    def refresh(self):
+        for item in self.tree.get_children():
+            self.tree.delete(item)
+        try:
+            with sqlite3.connect(DB_FILE) as conn:
+                for receipt, original in load_receipt_tokens(conn).values():
+                    self.tree.insert("", "end", values=(receipt, original))
+        except sqlite3.Error as e:
+            messagebox.showerror("Database Error", f"Error loading receipt tokens: {e}", parent=self)
+
+    def on_select(self, event=None):
+        selected = self.tree.selection()
+        if selected:
+            receipt, original = self.tree.item(selected[0])['values']
+            self.receipt_var.set(receipt)
+            self.original_var.set(original)
+
+    def save(self):
+        receipt = self.receipt_var.get().strip()
+        original = self.original_var.get().strip()
+        if not receipt or not original:
+            messagebox.showerror("Input Error", "Receipt and original token are both required", parent=self)
+            return
+        try:
+            with sqlite3.connect(DB_FILE) as conn:
+                save_receipt_token(conn, receipt, original)
+        except sqlite3.Error as e:
+            messagebox.showerror("Database Error", f"Error saving receipt token: {e}", parent=self)
+        self.refresh()
+
+    def remove(self):
+        receipt = self.receipt_var.get().strip()
+        if not receipt:
+            return
+        try:
+            with sqlite3.connect(DB_FILE) as conn:
+                delete_receipt_token(conn, receipt)
+        except sqlite3.Error as e:
+            messagebox.showerror("Database Error", f"Error removing receipt token: {e}", parent=self)
+        self.receipt_var.set("")
+        self.original_var.set("")
+        self.refresh()
+
+
 class CryptoACBApp:
     def __init__(self, root):
         self.root = root
@@ -342,27 +2538,46 @@ class CryptoACBApp:
         self.load_geometry()
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
         
+        self.sort_column = None
+        self.sort_reverse = False
+        self.startup_complete = False
+        self.prices = PriceStore()
+
         init_db()
         self.setup_ui()
         self.load_data()
-        
-        self.sort_column = None
-        self.sort_reverse = False
+        self.root.after(STARTUP_DEFER_MS, self.finish_startup)
+
+    def finish_startup(self):
+        """Bring acb_state up to date if needed, then fill the visible tab."""
+        try:
+            with sqlite3.connect(DB_FILE) as conn:
+                if not acb_state_is_current(conn):
+                    self.recompute_acb(conn)
+                    conn.commit()
+        except sqlite3.Error as e:
+            messagebox.showerror("Database Error", f"Error refreshing ACB state: {e}")
+        self.refresh_visible_tab()
+        self.startup_complete = True
+        self.root.after(VERIFY_INTERVAL_MS, self.verify_acb)
 
     def load_geometry(self):
-        """Load window geometry from ledge.ini, or use default"""
+        """Load window geometry and last selected tab from ledge.ini, or use defaults"""
         config = configparser.ConfigParser()
+        self.initial_tab = 0
         if os.path.exists('ledge.ini'):
             try:
                 config.read('ledge.ini')
                 geom = config.get('window', 'geometry', fallback='950x600+100+100')
                 self.root.geometry(geom)
+                self.initial_tab = config.getint('window', 'tab', fallback=0)
             except:
                 self.root.geometry('950x600+100+100')
         else:
             self.root.geometry('950x600+100+100')
     
     def on_closing(self):
+        self.cancel_transaction_query()
         self.save_geometry()
         self.root.destroy()
 
@@ -420,6 +2635,26 @@ class CryptoACBApp:
         self.amount_to_var = tk.StringVar()
         ttk.Entry(amount_frame, textvariable=self.amount_to_var, width=10).pack(side=tk.LEFT, padx=5)
 
+        notes_frame = ttk.Frame(self.filter_frame)
+        notes_frame.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Label(notes_frame, text="Notes:").pack(side=tk.LEFT, padx=5)
+        self.notes_filter_var = tk.StringVar()
+        ttk.Entry(notes_frame, textvariable=self.notes_filter_var, width=30).pack(side=tk.LEFT, padx=5)
+        self.archived_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(notes_frame, text="Closed years (read-only)",
+                        variable=self.archived_var).pack(side=tk.LEFT, padx=5)
+
+        self._query_generation = 0
+        self._query_conns = set()
+        self._query_lock = threading.Lock()
+        self._query_queue = queue.Queue()
+        self._filter_after_id = None
+        self._pending_focus = None
+        for var in (self.date_from_var, self.date_to_var, self.token_filter_var,
+                    self.action_filter_var, self.amount_from_var, self.amount_to_var,
+                    self.notes_filter_var, self.archived_var):
+            var.trace_add("write", self.schedule_filter)
+
         btn_frame = ttk.Frame(self.filter_frame)
         btn_frame.pack(fill=tk.X, padx=5, pady=5)
         ttk.Button(btn_frame, text="Apply Filters", command=self.apply_filters).pack(side=tk.LEFT, padx=5)
@@ -430,10 +2665,16 @@ class CryptoACBApp:
         ttk.Button(trans_btn_frame, text="Add", command=self.add_transaction).pack(side=tk.LEFT, padx=5)
         ttk.Button(trans_btn_frame, text="Edit", command=self.edit_transaction).pack(side=tk.LEFT, padx=5)
         ttk.Button(trans_btn_frame, text="Delete", command=self.delete_transaction).pack(side=tk.LEFT, padx=5)
+        ttk.Button(trans_btn_frame, text="Check Integrity", command=self.check_integrity).pack(side=tk.LEFT, padx=5)
         ttk.Button(trans_btn_frame, text="Export CSV", command=self.export_csv).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(trans_btn_frame, text="Import CSV", command=self.import_csv).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(trans_btn_frame, text="Load FX Rates", command=self.load_fx_rates).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(trans_btn_frame, text="Find Duplicates", command=self.find_duplicates).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(trans_btn_frame, text="Receipt Tokens", command=self.edit_receipt_tokens).pack(side=tk.RIGHT, padx=5)
 
         self.cols = ("ID", "Date", "Action", "ReceivedToken", "ReceivedAmt", "ReceivedCAD",
-                     "SentToken", "SentAmt", "SentCAD", "FeeCAD", "GasCAD", "Notes")
+                     "SentToken", "SentAmt", "SentCAD", "FeeCAD", "GasCAD", "Notes",
+                     "Gain", "UnitsAfter", "ACBAfter", "DeniedLoss")
         self.trans_tree = ttk.Treeview(self.trans_frame, columns=self.cols, show="headings", height=15)
         
         self.sort_column = None
@@ -442,7 +2683,8 @@ class CryptoACBApp:
             "ID": 40, "Date": 100, "Action": 80,
             "ReceivedToken": 90, "ReceivedAmt": 90, "ReceivedCAD": 90,
             "SentToken": 90, "SentAmt": 90, "SentCAD": 90,
-            "Notes": 200
+            "Notes": 200,
+            "Gain": 90, "UnitsAfter": 110, "ACBAfter": 90, "DeniedLoss": 90
         }
         for col in self.cols:
             heading_cmd = lambda c=col: self.sort_by_column(c)
@@ -456,36 +2698,127 @@ class CryptoACBApp:
         self.trans_tree.configure(yscroll=vscroll.set)
         vscroll.pack(side=tk.RIGHT, fill=tk.Y)
 
+        self.integrity_frame = ttk.LabelFrame(self.trans_frame, text="Ledger Integrity")
+        integrity_bar = ttk.Frame(self.integrity_frame)
+        integrity_bar.pack(fill=tk.X)
+        self.integrity_status = ttk.Label(integrity_bar, text="")
+        self.integrity_status.pack(side=tk.LEFT, padx=5)
+        ttk.Button(integrity_bar, text="Close", command=self.integrity_frame.pack_forget).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(integrity_bar, text="Re-check", command=self.check_integrity).pack(side=tk.RIGHT, padx=5)
+        integrity_cols = ("ID", "Date", "Token", "Issue")
+        self.integrity_tree = ttk.Treeview(self.integrity_frame, columns=integrity_cols, show="headings", height=6)
+        for col in integrity_cols:
+            self.integrity_tree.heading(col, text=col)
+            self.integrity_tree.column(col, width=500 if col == "Issue" else 90)
+        self.integrity_tree.pack(fill=tk.BOTH, expand=True, pady=5)
+        self.integrity_tree.bind("<Double-1>", self.on_integrity_select)
+
         self.acb_frame = ttk.Frame(self.notebook)
         self.notebook.add(self.acb_frame, text="ACB Summary")
 
-        acb_cols = ("Token", "UnitsHeld", "TotalACB", "ACBperUnit")
+        acb_btn_frame = ttk.Frame(self.acb_frame)
+        acb_btn_frame.pack(fill=tk.X, pady=5)
+        ttk.Button(acb_btn_frame, text="Import Prices", command=self.import_prices).pack(side=tk.RIGHT, padx=5)
+
+        acb_cols = ("Token", "UnitsHeld", "TotalACB", "ACBperUnit", "Price", "MarketValue", "Unrealized")
         self.acb_tree = ttk.Treeview(self.acb_frame, columns=acb_cols, show="headings", height=15)
         for col in acb_cols:
             self.acb_tree.heading(col, text=col)
-            self.acb_tree.column(col, width=150)
+            self.acb_tree.column(col, width=120)
         self.acb_tree.pack(fill=tk.BOTH, expand=True, pady=5)
 
         self.report_frame = ttk.Frame(self.notebook)
         self.notebook.add(self.report_frame, text="Reports")
 
+        report_btn_frame = ttk.Frame(self.report_frame)
+        report_btn_frame.pack(fill=tk.X, pady=5)
+        ttk.Button(report_btn_frame, text="Export Schedule 3", command=self.export_schedule3).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(report_btn_frame, text="Export Snapshot", command=self.export_snapshot).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(report_btn_frame, text="Close Tax Year", command=self.close_tax_year).pack(side=tk.LEFT, padx=5)
+        ttk.Button(report_btn_frame, text="Reopen Tax Year", command=self.reopen_tax_year).pack(side=tk.LEFT, padx=5)
+
         self.report_text = tk.Text(self.report_frame, wrap=tk.WORD, padx=10, pady=10)
         self.report_text.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
-        self.update_report()
+
+        self.sim_frame = ttk.Frame(self.notebook)
+        self.notebook.add(self.sim_frame, text="Simulate")
+
+        ttk.Label(self.sim_frame,
+                  text="One order per line: SELL 1 BTC @ 60000 | BUY 2 ETH @ 3500 | "
+                       "TRADE 2 ETH FOR 0.1 BTC @ 3500 (optional FEE 10)").pack(anchor=tk.W, padx=5, pady=5)
+        self.sim_text = tk.Text(self.sim_frame, height=6, padx=5, pady=5)
+        self.sim_text.pack(fill=tk.X, padx=5)
+        sim_btn_frame = ttk.Frame(self.sim_frame)
+        sim_btn_frame.pack(fill=tk.X, pady=5)
+        ttk.Button(sim_btn_frame, text="Simulate", command=self.run_simulation).pack(side=tk.LEFT, padx=5)
+        self.sim_total = ttk.Label(sim_btn_frame, text="")
+        self.sim_total.pack(side=tk.LEFT, padx=5)
+
+        sim_cols = ("Order", "Proceeds", "ACB", "Gain", "UnitsLeft", "ACBperUnit", "Warning")
+        self.sim_tree = ttk.Treeview(self.sim_frame, columns=sim_cols, show="headings", height=10)
+        for col in sim_cols:
+            self.sim_tree.heading(col, text=col)
+            self.sim_tree.column(col, width=220 if col in ("Order", "Warning") else 100)
+        self.sim_tree.pack(fill=tk.BOTH, expand=True, pady=5)
+
+        self.chart_frame = ttk.Frame(self.notebook)
+        self.notebook.add(self.chart_frame, text="Charts")
+
+        chart_bar = ttk.Frame(self.chart_frame)
+        chart_bar.pack(fill=tk.X, pady=5)
+        ttk.Label(chart_bar, text="Token:").pack(side=tk.LEFT, padx=5)
+        self.chart_token_var = tk.StringVar(value=TOTAL_ACB_SERIES)
+        self.chart_token = ttk.Combobox(chart_bar, textvariable=self.chart_token_var, state="readonly", width=14)
+        self.chart_token.pack(side=tk.LEFT, padx=5)
+        ttk.Label(chart_bar, text="Show:").pack(side=tk.LEFT, padx=5)
+        self.chart_metric_var = tk.StringVar(value="ACB")
+        ttk.Combobox(chart_bar, textvariable=self.chart_metric_var, values=["ACB", "Units"],
+                     state="readonly", width=8).pack(side=tk.LEFT, padx=5)
+        ttk.Button(chart_bar, text="Reset Zoom", command=lambda: self.chart.reset_view()).pack(side=tk.LEFT, padx=5)
+        ttk.Label(chart_bar, text="Wheel to zoom, drag to pan").pack(side=tk.RIGHT, padx=5)
+        self.chart = TimeSeriesChart(self.chart_frame)
+        self.chart.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.chart_series = {}
+        self.chart_token_var.trace_add("write", lambda *args: self.show_chart())
+        self.chart_metric_var.trace_add("write", lambda *args: self.show_chart())
+
+        self.tab_loaders = {
+            str(self.trans_frame): self.load_transactions,
+            str(self.acb_frame): self.load_acb_summary,
+            str(self.report_frame): self.update_report,
+            str(self.chart_frame): self.load_charts,
+        }
+        self.stale_tabs = set()
+        tabs = self.notebook.tabs()
+        if 0 <= self.initial_tab < len(tabs):
+            self.notebook.select(tabs[self.initial_tab])
+        self.notebook.bind("<<NotebookTabChanged>>", lambda event: self.refresh_visible_tab())
 
     def load_data(self):
-        self.load_transactions()
-        self.load_acb_summary()
+        """Mark every tab out of date; each reloads when it is next shown."""
+        self.stale_tabs = set(self.tab_loaders)
+        if self.startup_complete:
+            self.refresh_visible_tab()
 
-    def load_transactions(self):
-        for item in self.trans_tree.get_children():
-            self.trans_tree.delete(item)
+    def refresh_visible_tab(self):
+        """Load the selected tab if its contents are out of date."""
+        current = self.notebook.select()
+        if current in self.stale_tabs:
+            self.stale_tabs.discard(current)
+            self.tab_loaders[current]()
 
+    def build_transaction_query(self):
+        """Build the filtered transaction query. Returns (sql, params, error)."""
+        table, acb_table = (("archived_transactions", "archived_transaction_acb")
+                            if self.archived_var.get() else ("transactions", "transaction_acb"))
         query = ["SELECT id, date, action, token, token_amount, cad_amount,"
-                "       sent_token, sent_amount, sent_cad, fee_cad, gas_cad, notes",
-                "FROM transactions",
+                "       sent_token, sent_amount, sent_cad, fee_cad, gas_cad, notes,"
+                "       realized_gain, units_after, acb_per_unit_after, denied_loss",
+                f"FROM {table}",
+                f"LEFT JOIN {acb_table} ON {acb_table}.transaction_id = {table}.id",
                 "WHERE 1=1"]
         params = []
+        error = None
 
         if self.date_from_var.get():
             query.append("AND date >= ?")
@@ -512,47 +2845,160 @@ class CryptoACBApp:
                 query.append("AND (cad_amount <= ? OR sent_cad <= ?)")
                 params.extend([amount_to, amount_to])
         except ValueError:
-            messagebox.showwarning("Filter Error", "Invalid amount filter value")
+            error = "Invalid amount filter value"
+
+        if self.notes_filter_var.get():
+            query.append("AND notes LIKE ?")
+            params.append(f"%{self.notes_filter_var.get()}%")
+
+        if self.sort_column:
+            sort_col = self.sort_column.lower()
+            col_map = {
+                'receivedtoken': 'token',
+                'receivedamt': 'token_amount',
+                'receivedcad': 'cad_amount',
+                'senttoken': 'sent_token',
+                'sentamt': 'sent_amount',
+                'sentcad': 'sent_cad',
+                'feecad': 'fee_cad',
+                'gascad': 'gas_cad',
+                'gain': 'realized_gain',
+                'unitsafter': 'units_after',
+                'acbafter': 'acb_per_unit_after',
+                'deniedloss': 'denied_loss'
+            }
+            sort_col = col_map.get(sort_col, sort_col)
+            query.append(f"ORDER BY {sort_col} {'DESC' if self.sort_reverse else 'ASC'}, id")
+        else:
+            query.append("ORDER BY date DESC, id DESC")
+
+        return " ".join(query), params, error
+
+    def schedule_filter(self, *args):
+        """Debounce filter edits: abort any running query and reload shortly."""
+        self.cancel_transaction_query()
+        if self._filter_after_id is not None:
+            self.root.after_cancel(self._filter_after_id)
+        self._filter_after_id = self.root.after(FILTER_DEBOUNCE_MS, self.load_transactions)
+
+    def cancel_transaction_query(self):
+        """Abort every in-flight transaction query, if any."""
+        with self._query_lock:
+            self._query_generation += 1
+            for conn in self._query_conns:
+                try:
+                    conn.interrupt()
+                except sqlite3.ProgrammingError:
+                    pass
+
+    def load_transactions(self):
+        """Start a background query and stream matching rows into the view."""
+        if self._filter_after_id is not None:
+            self.root.after_cancel(self._filter_after_id)
+            self._filter_after_id = None
+        self.cancel_transaction_query()
+        generation = self._query_generation
+
+        for item in self.trans_tree.get_children():
+            self.trans_tree.delete(item)
+
+        sql, params, error = self.build_transaction_query()
+        if error:
+            self.filter_status.config(text=error)
+            return
+        self.filter_status.config(text="Searching...")
 
-        if self.sort_column:
-            sort_col = self.sort_column.lower()
-            if sort_col in ['receivedamt', 'receivedcad', 'sentamt', 'sentcad', 'feecad', 'gascad']:
-                col_map = {
-                    'receivedamt': 'token_amount',
-                    'receivedcad': 'cad_amount',
-                    'sentamt': 'sent_amount',
-                    'sentcad': 'sent_cad',
-                    'feecad': 'fee_cad',
-                    'gascad': 'gas_cad'
-                }
-                sort_col = col_map.get(sort_col, sort_col)
-            query.append(f"ORDER BY {sort_col} {'DESC' if self.sort_reverse else 'ASC'}, id")
-        else:
-            query.append("ORDER BY date DESC, id DESC")
+        worker = threading.Thread(
+            target=self._query_worker, args=(generation, sql, params), daemon=True)
+        worker.start()
+        self._match_count = 0
+        self.root.after(20, self._drain_query_results, generation)
+
+        self.update_token_choices()
 
+    def _query_worker(self, generation, sql, params):
+        """Run the transaction query off the UI thread, posting rows in batches."""
+        error = None
         try:
-            with sqlite3.connect(DB_FILE) as conn:
-                cur = conn.execute(" ".join(query), params)
-                for row in cur.fetchall():
-                    fmt_row = (
-                        row[0],
-                        row[1],
-                        row[2],
-                        row[3] or "",
-                        f"{row[4]:.8f}" if row[4] is not None else "",
-                        f"${row[5]:.2f}" if row[5] is not None else "",
-                        row[6] or "",
-                        f"{row[7]:.8f}" if row[7] is not None else "",
-                        f"${row[8]:.2f}" if row[8] is not None else "",
-                        f"${row[9]:.2f}" if row[9] is not None else "",
-                        f"${row[10]:.2f}" if row[10] is not None else "",
-                        row[11] or ""
-                    )
-                    self.trans_tree.insert("", "end", values=fmt_row)
+            conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+        except sqlite3.Error as e:
+            self._query_queue.put((generation, None, str(e)))
+            return
+        # Register before checking the generation, under the same lock as
+        # cancel, so a cancel either sees this connection or is seen here.
+        with self._query_lock:
+            self._query_conns.add(conn)
+            cancelled = generation != self._query_generation
+        # An interrupt that lands before the statement starts is a no-op, so
+        # the statement also aborts itself once its generation is stale.
+        conn.set_progress_handler(lambda: generation != self._query_generation, 10000)
+        try:
+            if cancelled:
+                return
+            cur = conn.execute(sql, params)
+            while generation == self._query_generation:
+                rows = cur.fetchmany(FILTER_BATCH_SIZE)
+                if not rows:
+                    break
+                self._query_queue.put((generation, rows, None))
+        except sqlite3.OperationalError as e:
+            if "interrupt" not in str(e):
+                error = str(e)
         except sqlite3.Error as e:
-            messagebox.showerror("Database Error", f"Error loading transactions: {e}")
+            error = str(e)
+        finally:
+            with self._query_lock:
+                self._query_conns.discard(conn)
+            conn.close()
+            self._query_queue.put((generation, None, error))
 
-        self.update_token_choices()
+    def _drain_query_results(self, generation):
+        """Insert streamed rows into the tree and keep the match count current."""
+        if generation != self._query_generation:
+            return
+        done = False
+        while True:
+            try:
+                batch_generation, rows, error = self._query_queue.get_nowait()
+            except queue.Empty:
+                break
+            if batch_generation != generation:
+                continue
+            if rows is None:
+                done = True
+                if error:
+                    messagebox.showerror("Database Error", f"Error loading transactions: {error}")
+                break
+            for row in rows:
+                fmt_row = (
+                    row[0],
+                    row[1],
+                    row[2],
+                    row[3] or "",
+                    f"{row[4]:.8f}" if row[4] is not None else "",
+                    f"${row[5]:.2f}" if row[5] is not None else "",
+                    row[6] or "",
+                    f"{row[7]:.8f}" if row[7] is not None else "",
+                    f"${row[8]:.2f}" if row[8] is not None else "",
+                    f"${row[9]:.2f}" if row[9] is not None else "",
+                    f"${row[10]:.2f}" if row[10] is not None else "",
+                    row[11] or "",
+                    f"${row[12]:.2f}" if row[12] is not None else "",
+                    f"{row[13]:.8f}" if row[13] is not None else "",
+                    f"${row[14]:.4f}" if row[14] is not None else "",
+                    f"${row[15]:.2f}" if row[15] is not None else ""
+                )
+                self.trans_tree.insert("", "end", iid=str(row[0]), values=fmt_row)
+            self._match_count += len(rows)
+            if self._pending_focus is not None and self.trans_tree.exists(str(self._pending_focus)):
+                self.focus_transaction(self._pending_focus)
+
+        if done:
+            self._pending_focus = None
+            self.filter_status.config(text=f"{self._match_count} matching transaction(s)")
+        else:
+            self.filter_status.config(text=f"{self._match_count} match(es) so far...")
+            self.root.after(20, self._drain_query_results, generation)
 
     def load_acb_summary(self):
         for item in self.acb_tree.get_children():
@@ -560,11 +3006,18 @@ class CryptoACBApp:
         try:
             with sqlite3.connect(DB_FILE) as conn:
                 cur = conn.execute("SELECT token, units_held, total_acb FROM acb_state WHERE units_held > 0 ORDER BY token")
+                today = datetime.now().strftime("%Y-%m-%d")
                 for token, units, total in cur.fetchall():
                     units = float(units)
                     total = float(total)
                     acb_per = total / units if units > 0 else 0.0
-                    self.acb_tree.insert("", "end", values=(token, f"{units:.8f}", f"${total:.2f}", f"${acb_per:.4f}"))
+                    price = self.prices.price_on(token, today)
+                    if price is None:
+                        market = ("", "", "")
+                    else:
+                        value = units * price
+                        market = (f"${price:.4f}", f"${value:.2f}", f"${value - total:.2f}")
+                    self.acb_tree.insert("", "end", values=(token, f"{units:.8f}", f"${total:.2f}", f"${acb_per:.4f}") + market)
         except sqlite3.Error as e:
             messagebox.showerror("Database Error", f"Error loading ACB summary: {e}")
 
@@ -579,12 +3032,20 @@ class CryptoACBApp:
 
     def add_transaction(self):
         backup_database()
-        dialog = TransactionDialog(self.root)
+        dialog = TransactionDialog(self.root, prices=self.prices, currencies=self.currency_choices(),
+                                   receipt_tokens=self.receipt_token_map())
         if dialog.result:
             (date, token, action, token_amt, cad_amt, notes,
-             sent_token, sent_amt, sent_cad, fee_cad, gas_cad) = dialog.result
+             sent_token, sent_amt, sent_cad, fee_cad, gas_cad, native_currency, rate) = dialog.result
 
             with sqlite3.connect(DB_FILE) as conn:
+                base = transaction_fingerprint(date, action, token, token_amt, cad_amt,
+                                               sent_token, sent_amt, sent_cad)
+                fingerprint, occurrence = next_free_fingerprint(conn, base)
+                if occurrence and not messagebox.askyesno(
+                        "Possible Duplicate",
+                        "An identical transaction already exists. Add it anyway?"):
+                    return
                 conn.execute('BEGIN')
                 try:
                     if action in ("Stake", "Unstake"):
@@ -599,10 +3060,12 @@ class CryptoACBApp:
                     conn.execute("""
                         INSERT INTO transactions
                         (date, token, action, token_amount, cad_amount, notes,
-                         sent_token, sent_amount, sent_cad, fee_cad, gas_cad)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                         sent_token, sent_amount, sent_cad, fee_cad, gas_cad, fingerprint,
+                         native_currency, fx_rate)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                     """, (date, token, action, token_amt, cad_amt, notes,
-                          sent_token, sent_amt, sent_cad, fee_cad, gas_cad))
+                          sent_token, sent_amt, sent_cad, fee_cad, gas_cad, fingerprint,
+                          native_currency, rate))
                     
                     self.recompute_acb(conn)
                     conn.commit()
@@ -616,7 +3079,10 @@ class CryptoACBApp:
     def save_geometry(self):
         """Save window geometry to ledge.ini"""
         config = configparser.ConfigParser()
-        config['window'] = {'geometry': self.root.geometry()}
+        config['window'] = {
+            'geometry': self.root.geometry(),
+            'tab': str(self.notebook.index(self.notebook.select())),
+        }
         with open('ledge.ini', 'w') as f:
             config.write(f)
 
@@ -625,6 +3091,9 @@ class CryptoACBApp:
         if not selected:
             messagebox.showwarning("Select", "Please select a transaction to edit.")
             return
+        if self.archived_var.get():
+            messagebox.showwarning("Closed Year", "Transactions in closed years are read-only. Reopen the year to change them.")
+            return
         item = self.trans_tree.item(selected[0])
         values = item['values']
         trans_id = values[0]
@@ -657,6 +3126,22 @@ class CryptoACBApp:
         gas_cad = parse_currency(values[10]) if values[10] else 0.0
         notes = values[11] or ""
 
+        native_currency = None
+        try:
+            with sqlite3.connect(DB_FILE) as conn:
+                stored = conn.execute("""
+                    SELECT token_amount, cad_amount, sent_amount, sent_cad, fee_cad, gas_cad, native_currency, fx_rate
+                    FROM transactions WHERE id=?
+                """, (trans_id,)).fetchone()
+        except sqlite3.Error:
+            stored = None
+        if stored and stored[6] and stored[7]:
+            native_currency, rate = stored[6:]
+            rec_cad, sent_cad, fee_cad, gas_cad = (
+                round((v or 0.0) / rate, 2) for v in (stored[1], stored[3], stored[4], stored[5]))
+        shown = (rec_amt, rec_cad, sent_amt, sent_cad, fee_cad, gas_cad)
+        old_date = date
+
         old_row = (
             None,
             date,
@@ -669,24 +3154,53 @@ class CryptoACBApp:
             sent_amt,
             sent_cad,
             fee_cad,
-            gas_cad
+            gas_cad,
+            native_currency
         )
 
-        dialog = TransactionDialog(self.root, old_row)
+        dialog = TransactionDialog(self.root, old_row, prices=self.prices, currencies=self.currency_choices(),
+                                   receipt_tokens=self.receipt_token_map())
         if dialog.result:
             (date, token, action, token_amt, cad_amt, notes,
-            sent_token, sent_amt, sent_cad, fee_cad, gas_cad) = dialog.result
+            sent_token, sent_amt, sent_cad, fee_cad, gas_cad, native_currency, rate) = dialog.result
+
+            # The dialog shows amounts rounded for display. Any amount left as
+            # shown keeps its stored value, so opening and saving a row does not
+            # move it; with a foreign currency this needs the same date and rate.
+            if stored and native_currency == stored[6] and (native_currency is None or date == old_date):
+                if native_currency:
+                    # Convert any changed amounts at the stored rate too, so it stays the row's rate.
+                    rate = stored[7]
+                    cad_amt, sent_cad, fee_cad, gas_cad = convert_to_cad(
+                        rate, dialog.entered[1], dialog.entered[3], dialog.entered[4], dialog.entered[5])
+                new = (token_amt, cad_amt, sent_amt, sent_cad, fee_cad, gas_cad)
+                (token_amt, cad_amt, sent_amt, sent_cad, fee_cad, gas_cad) = (
+                    kept if entered == was else value
+                    for entered, was, kept, value in zip(dialog.entered, shown, stored, new))
 
             with sqlite3.connect(DB_FILE) as conn:
+                row = conn.execute("SELECT ext_tx_id, fingerprint FROM transactions WHERE id=?", (trans_id,)).fetchone()
+                ext_tx_id, old_fingerprint = row if row else (None, None)
+                base = transaction_fingerprint(date, action, token, token_amt, cad_amt,
+                                               sent_token, sent_amt, sent_cad, ext_tx_id)
+                fingerprint, occurrence = next_free_fingerprint(conn, base, exclude_id=trans_id)
+                if occurrence and not messagebox.askyesno(
+                        "Possible Duplicate",
+                        "The edited transaction is identical to an existing one. Save anyway?"):
+                    return
                 conn.execute('BEGIN')
                 try:
                     conn.execute('''
                         UPDATE transactions
                         SET date=?, token=?, action=?, token_amount=?, cad_amount=?, notes=?,
-                            sent_token=?, sent_amount=?, sent_cad=?, fee_cad=?, gas_cad=?
+                            sent_token=?, sent_amount=?, sent_cad=?, fee_cad=?, gas_cad=?,
+                            fingerprint=?, native_currency=?, fx_rate=?
                         WHERE id=?
                     ''', (date, token, action, token_amt, cad_amt, notes,
-                        sent_token, sent_amt, sent_cad, fee_cad, gas_cad, trans_id))
+                        sent_token, sent_amt, sent_cad, fee_cad, gas_cad, fingerprint,
+                        native_currency, rate, trans_id))
+                    renumber_fingerprints(conn, old_fingerprint)
+                    renumber_fingerprints(conn, fingerprint)
                     self.recompute_acb(conn)
                     conn.commit()
                 except Exception as e:
@@ -700,12 +3214,17 @@ class CryptoACBApp:
         if not selected:
             messagebox.showwarning("Select", "Please select a transaction to delete.")
             return
+        if self.archived_var.get():
+            messagebox.showwarning("Closed Year", "Transactions in closed years are read-only. Reopen the year to change them.")
+            return
         trans_id = self.trans_tree.item(selected[0])['values'][0]
         if messagebox.askyesno("Confirm", "Delete this transaction? ACB will be recalculated."):
             with sqlite3.connect(DB_FILE) as conn:
                 conn.execute('BEGIN')
                 try:
+                    row = conn.execute("SELECT fingerprint FROM transactions WHERE id=?", (trans_id,)).fetchone()
                     conn.execute("DELETE FROM transactions WHERE id=?", (trans_id,))
+                    renumber_fingerprints(conn, row[0] if row else None)
                     self.recompute_acb(conn)
                     conn.commit()
                 except Exception as e:
@@ -723,250 +3242,39 @@ class CryptoACBApp:
             should_close = True
 
         try:
-            cur = conn.execute("""
-                SELECT date, token, action, token_amount, cad_amount,
-                       sent_token, sent_amount, sent_cad,
-                       fee_cad, gas_cad
-                FROM transactions
-                ORDER BY date, id
-            """)
-            rows = cur.fetchall()
-            
-            acb_state = defaultdict(lambda: {"total_acb": decimal.Decimal(0), "units_held": decimal.Decimal(0)})
-
-            for row in rows:
-                (date, token, action, token_amt, cad_amt,
-                 sent_token, sent_amt, sent_cad, fee_cad, gas_cad) = row
-
-                token_amt = decimal.Decimal(token_amt)
-                cad_amt = decimal.Decimal(cad_amt)
-                sent_amt = decimal.Decimal(sent_amt) if sent_amt is not None else decimal.Decimal(0)
-                sent_cad = decimal.Decimal(sent_cad) if sent_cad is not None else decimal.Decimal(0)
-                fee_cad = decimal.Decimal(fee_cad) if fee_cad is not None else decimal.Decimal(0)
-                gas_cad = decimal.Decimal(gas_cad) if gas_cad is not None else decimal.Decimal(0)
-
-                if gas_cad > 0:
-                    acb_state["GAS_FEES"]["total_acb"] -= gas_cad
-
-                if action == "Buy":
-                    total_cost = cad_amt + fee_cad
-                    acb_state[token]["total_acb"] += total_cost
-                    acb_state[token]["units_held"] += token_amt
-                elif action == "Sell":
-                    state = acb_state[token]
-                    if state["units_held"] > 0:
-                        try:
-                            acb_per = state["total_acb"] / state["units_held"]
-                            cost_basis = acb_per * token_amt
-                            state["total_acb"] = max(decimal.Decimal(0), state["total_acb"] - cost_basis)
-                            state["units_held"] = max(decimal.Decimal(0), state["units_held"] - token_amt)
-                        except ZeroDivisionError:
-                            pass
-                elif action == "Trade":
-                    if sent_token and sent_amt and sent_cad is not None:
-                        sent_state = acb_state[sent_token]
-                        if sent_state["units_held"] > 0:
-                            try:
-                                acb_per_sent = sent_state["total_acb"] / sent_state["units_held"]
-                                cost_basis = acb_per_sent * sent_amt
-                                sent_state["total_acb"] = max(decimal.Decimal(0), sent_state["total_acb"] - cost_basis)
-                                sent_state["units_held"] = max(decimal.Decimal(0), sent_state["units_held"] - sent_amt)
-                            except ZeroDivisionError:
-                                pass
-                    total_cost = cad_amt + fee_cad
-                    acb_state[token]["total_acb"] += total_cost
-                    acb_state[token]["units_held"] += token_amt
-                elif action == "Stake":
-                    original_state = acb_state[token]
-                    if original_state["units_held"] > 0:
-                        try:
-                            acb_per_unit_original = original_state["total_acb"] / original_state["units_held"]
-                            acb_for_staked_out = acb_per_unit_original * token_amt
-                            original_state["total_acb"] = max(decimal.Decimal(0), original_state["total_acb"] - acb_for_staked_out)
-                            original_state["units_held"] = max(decimal.Decimal(0), original_state["units_held"] - token_amt)
-                        except ZeroDivisionError:
-                            original_state["units_held"] = max(decimal.Decimal(0), original_state["units_held"] - token_amt)
-                            acb_for_staked_out = decimal.Decimal(0)
-                    else:
-                        original_state["units_held"] = max(decimal.Decimal(0), original_state["units_held"] - token_amt)
-                        acb_for_staked_out = decimal.Decimal(0)
-                    
-                    receipt_state = acb_state[sent_token]
-                    receipt_state["total_acb"] += acb_for_staked_out
-                    receipt_state["units_held"] += sent_amt
-                elif action == "Unstake":
-                    receipt_state = acb_state[token]
-                    if receipt_state["units_held"] > 0:
-                        try:
-                            acb_per_unit_receipt = receipt_state["total_acb"] / receipt_state["units_held"]
-                            acb_for_unstaked_out = acb_per_unit_receipt * token_amt
-                            receipt_state["total_acb"] = max(decimal.Decimal(0), receipt_state["total_acb"] - acb_for_unstaked_out)
-                            receipt_state["units_held"] = max(decimal.Decimal(0), receipt_state["units_held"] - token_amt)
-                        except ZeroDivisionError:
-                            receipt_state["units_held"] = max(decimal.Decimal(0), receipt_state["units_held"] - token_amt)
-                            acb_for_unstaked_out = decimal.Decimal(0)
-                    else:
-                        receipt_state["units_held"] = max(decimal.Decimal(0), receipt_state["units_held"] - token_amt)
-                        acb_for_unstaked_out = decimal.Decimal(0)
-                    
-                    original_state = acb_state[sent_token]
-                    original_state["total_acb"] += acb_for_unstaked_out
-                    original_state["units_held"] += sent_amt
-                elif action == "Reward":
-                    acb_state[token]["total_acb"] += cad_amt
-                    acb_state[token]["units_held"] += token_amt
-                elif action == "Fee":
-                    state = acb_state[token]
-                    if state["units_held"] > 0:
-                        try:
-                            acb_per = state["total_acb"] / state["units_held"]
-                            cost_basis = acb_per * token_amt
-                            state["total_acb"] = max(decimal.Decimal(0), state["total_acb"] - cost_basis)
-                            state["units_held"] = max(decimal.Decimal(0), state["units_held"] - token_amt)
-                        except ZeroDivisionError:
-                            pass
-                    else:
-                        state["units_held"] = max(decimal.Decimal(0), state["units_held"] - token_amt)
+            rows, acb_state, acquisitions = replay_source(conn)
+            steps = [
+                (step.trans_id, step.realized_gain, step.units_after, step.acb_per_unit_after,
+                 step.denied_loss or None)
+                for step in replay_ledger(rows, acb_state, acquisitions)
+            ]
 
-            for token, state in acb_state.items():
-                conn.execute(
-                    "INSERT OR REPLACE INTO acb_state (token, total_acb, units_held) VALUES (?, ?, ?)",
-                    (token, state["total_acb"], state["units_held"])
-                )
+            conn.execute("DELETE FROM acb_state")
+            conn.executemany(
+                "INSERT INTO acb_state (token, total_acb, units_held) VALUES (?, ?, ?)",
+                ((token, state.total_acb, state.units_held) for token, state in acb_state.items())
+            )
+            conn.execute("DELETE FROM transaction_acb")
+            conn.executemany(
+                "INSERT INTO transaction_acb"
+                " (transaction_id, realized_gain, units_after, acb_per_unit_after, denied_loss)"
+                " VALUES (?, ?, ?, ?, ?)",
+                steps
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO ledger_meta (key, value) VALUES ('acb_version', ?)",
+                (ledger_version(conn),)
+            )
         finally:
             if should_close:
                 conn.close()
 
-        self.load_acb_summary()
-
     def generate_report_data(self):
         with sqlite3.connect(DB_FILE) as conn:
-            cur = conn.execute("""
-                SELECT date, token, action, token_amount, cad_amount,
-                       sent_token, sent_amount, sent_cad,
-                       fee_cad, gas_cad
-                FROM transactions
-                ORDER BY date, id
-            """)
-            acb_state = defaultdict(lambda: {"total_acb": 0.0, "units_held": 0.0})
-            total_realized_gain = 0.0
-            total_gas_loss = 0.0
-            total_exchange_fees = 0.0
-            action_counts = defaultdict(int)
-            
-            token_gains = defaultdict(float)
-            token_gas = defaultdict(float)
-
-            for row in cur.fetchall():
-                (date, token, action, token_amt, cad_amt,
-                 sent_token, sent_amt, sent_cad, fee_cad, gas_cad) = row
-                action_counts[action] += 1
-                fee_cad = fee_cad or 0.0
-                gas_cad = gas_cad or 0.0
-                total_exchange_fees += fee_cad
-                total_gas_loss += gas_cad
-                if gas_cad > 0:
-                    token_gas[token] += gas_cad
-
-                if action == "Buy":
-                    total_cost = cad_amt + fee_cad
-                    acb_state[token]["total_acb"] += total_cost
-                    acb_state[token]["units_held"] += token_amt
-                elif action == "Sell":
-                    net_proceeds = cad_amt - fee_cad
-                    state = acb_state[token]
-                    if state["units_held"] <= 0:
-                        realized_gain = net_proceeds
-                    else:
-                        acb_per = state["total_acb"] / state["units_held"]
-                        cost_basis = acb_per * token_amt
-                        realized_gain = net_proceeds - cost_basis
-                        state["total_acb"] = max(0.0, state["total_acb"] - cost_basis)
-                        state["units_held"] = max(0.0, state["units_held"] - token_amt)
-                    total_realized_gain += realized_gain
-                    token_gains[token] += realized_gain
-                elif action == "Trade":
-                    if sent_token and sent_amt and sent_cad is not None:
-                        sent_state = acb_state[sent_token]
-                        if sent_state["units_held"] <= 0:
-                            realized_gain_sent = sent_cad
-                        else:
-                            acb_per_sent = sent_state["total_acb"] / sent_state["units_held"]
-                            cost_basis_sent = acb_per_sent * sent_amt
-                            realized_gain_sent = sent_cad - cost_basis_sent
-                            sent_state["total_acb"] = max(0.0, sent_state["total_acb"] - cost_basis_sent)
-                            sent_state["units_held"] = max(0.0, sent_state["units_held"] - sent_amt)
-                        total_realized_gain += realized_gain_sent
-                        token_gains[sent_token] += realized_gain_sent
-                    total_cost = cad_amt + fee_cad
-                    acb_state[token]["total_acb"] += total_cost
-                    acb_state[token]["units_held"] += token_amt
-                elif action == "Stake":
-                    original_state = acb_state[token]
-                    if original_state["units_held"] > 0:
-                        try:
-                            acb_per_unit = original_state["total_acb"] / original_state["units_held"]
-                            acb_for_out = acb_per_unit * token_amt
-                            original_state["total_acb"] = max(0.0, original_state["total_acb"] - acb_for_out)
-                            original_state["units_held"] = max(0.0, original_state["units_held"] - token_amt)
-                        except ZeroDivisionError:
-                            original_state["units_held"] = max(0.0, original_state["units_held"] - token_amt)
-                            acb_for_out = 0.0
-                    else:
-                        original_state["units_held"] = max(0.0, original_state["units_held"] - token_amt)
-                        acb_for_out = 0.0
-                    receipt_state = acb_state[sent_token]
-                    receipt_state["total_acb"] += acb_for_out
-                    receipt_state["units_held"] += sent_amt
-                elif action == "Unstake":
-                    receipt_state = acb_state[token]
-                    if receipt_state["units_held"] > 0:
-                        try:
-                            acb_per_unit = receipt_state["total_acb"] / receipt_state["units_held"]
-                            acb_for_out = acb_per_unit * token_amt
-                            receipt_state["total_acb"] = max(0.0, receipt_state["total_acb"] - acb_for_out)
-                            receipt_state["units_held"] = max(0.0, receipt_state["units_held"] - token_amt)
-                        except ZeroDivisionError:
-                            receipt_state["units_held"] = max(0.0, receipt_state["units_held"] - token_amt)
-                            acb_for_out = 0.0
-                    else:
-                        receipt_state["units_held"] = max(0.0, receipt_state["units_held"] - token_amt)
-                        acb_for_out = 0.0
-                    original_state = acb_state[sent_token]
-                    original_state["total_acb"] += acb_for_out
-                    original_state["units_held"] += sent_amt
-                elif action == "Fee":
-                    state = acb_state[token]
-                    if state["units_held"] <= 0:
-                        realized_loss = -cad_amt
-                    else:
-                        acb_per = state["total_acb"] / state["units_held"]
-                        cost_basis = acb_per * token_amt
-                        realized_loss = -cad_amt
-                        state["total_acb"] = max(0.0, state["total_acb"] - cost_basis)
-                        state["units_held"] = max(0.0, state["units_held"] - token_amt)
-                    total_realized_gain += realized_loss
-                    token_gains[token] += realized_loss
-
-            current_holdings = {}
-            for token, state in acb_state.items():
-                if state["units_held"] > 0:
-                    current_holdings[token] = {
-                        "units": state["units_held"],
-                        "total_acb": state["total_acb"],
-                        "acb_per_unit": state["total_acb"] / state["units_held"]
-                    }
-
-            return {
-                "total_realized_gain": total_realized_gain,
-                "total_gas_loss": total_gas_loss,
-                "total_exchange_fees": total_exchange_fees,
-                "net_pnl": total_realized_gain - total_gas_loss,
-                "action_counts": dict(action_counts),
-                "token_gains": dict(token_gains),
-                "token_gas": dict(token_gas),
-                "current_holdings": current_holdings
-            }
+            data = compute_report_data(*replay_source(conn))
+            data["closed_through"] = closed_through(conn)
+            data["staking_positions"] = staking_report(conn, self.prices, datetime.now().strftime("%Y-%m-%d"))
+            return data
 
     def sort_by_column(self, column):
         """Sort treeview when a column header is clicked."""
@@ -1005,6 +3313,8 @@ class CryptoACBApp:
         self.action_filter_var.set("")
         self.amount_from_var.set("")
         self.amount_to_var.set("")
+        self.notes_filter_var.set("")
+        self.archived_var.set(False)
         self.load_transactions()
 
     def toggle_filters(self):
@@ -1019,47 +3329,12 @@ class CryptoACBApp:
             self.toggle_btn.configure(text="▲ Hide Filters")
 
     def update_report(self):
-        data = self.generate_report_data()
-        report = "📊 Ledge Tax & Portfolio Summary\n"
-        report += "=" * 40 + "\n\n"
-
-        report += "💰 Financial Summary\n"
-        report += f"Total Realized Capital Gains: ${data['total_realized_gain']:.2f}\n"
-        report += f"Total Gas Fees (Capital Losses): -${data['total_gas_loss']:.2f}\n"
-        report += f"Total Exchange Fees Paid: ${data['total_exchange_fees']:.2f}\n"
-        report += f"Net PnL (Gains - Gas Losses): ${data['net_pnl']:.2f}\n\n"
-
-        report += "📈 Activity Summary\n"
-        for action, count in sorted(data['action_counts'].items()):
-            report += f"{action}: {count} transaction(s)\n"
-        report += "\n"
-
-        if data['token_gains']:
-            report += "🔖 Realized Gains by Token\n"
-            for token, gain in sorted(data['token_gains'].items(), key=lambda x: -x[1]):
-                report += f"{token}: ${gain:.2f}\n"
-            report += "\n"
-
-        if data['current_holdings']:
-            report += "💼 Current Holdings\n"
-            for token, h in sorted(data['current_holdings'].items()):
-                report += f"{token}: {h['units']:.8f} units @ ${h['acb_per_unit']:.4f}/unit (ACB: ${h['total_acb']:.2f})\n"
-            report += "\n"
-
-        if data['token_gas']:
-            report += "⛽ Gas Fees by Token\n"
-            for token, gas in sorted(data['token_gas'].items(), key=lambda x: -x[1]):
-                report += f"{token}: -${gas:.2f}\n"
-            report += "\n"
-
-        report += "ℹ️ Note: Unrealized gains not included in PnL.\n"
-        report += "ℹ️ Use 'Export CSV' for full audit trail."
-
+        report = format_report(self.generate_report_data())
         self.report_text.delete(1.0, tk.END)
         self.report_text.insert(tk.END, report)
 
     def export_csv(self):
-        """Export all transactions to a CSV file."""
+        """Export all transactions, closed years included, to a CSV file."""
         path = filedialog.asksaveasfilename(
             defaultextension=".csv",
             filetypes=[("CSV files", "*.csv")],
@@ -1074,21 +3349,774 @@ class CryptoACBApp:
                 writer.writerow([
                     "Date", "Action", "Received Token", "Received Amount", "Received CAD",
                     "Sent Token", "Sent Amount", "Sent CAD",
-                    "Exchange Fee (CAD)", "Gas Fee (CAD)", "Notes"
+                    "Exchange Fee (CAD)", "Gas Fee (CAD)", "Notes", "External Tx ID",
+                    "Native Currency", "FX Rate"
                 ])
                 cur = conn.execute("""
                     SELECT date, action, token, token_amount, cad_amount,
-                           sent_token, sent_amount, sent_cad, fee_cad, gas_cad, notes
+                           sent_token, sent_amount, sent_cad, fee_cad, gas_cad, notes, ext_tx_id,
+                           native_currency, fx_rate, id
+                    FROM archived_transactions
+                    UNION ALL
+                    SELECT date, action, token, token_amount, cad_amount,
+                           sent_token, sent_amount, sent_cad, fee_cad, gas_cad, notes, ext_tx_id,
+                           native_currency, fx_rate, id
                     FROM transactions
-                    ORDER BY date, id
+                    ORDER BY 1, 15
                 """)
                 for row in cur.fetchall():
-                    writer.writerow(row)
+                    writer.writerow(row[:-1])
             messagebox.showinfo("Export", f"Transactions exported to:\n{path}")
         except Exception as e:
             messagebox.showerror("Export Error", f"Failed to export CSV:\n{e}")
 
-if __name__ == "__main__":
+    def check_integrity(self):
+        """Scan the ledger for negative running balances and show the results."""
+        try:
+            with sqlite3.connect(DB_FILE) as conn:
+                issues = check_ledger_integrity(conn)
+        except sqlite3.Error as e:
+            messagebox.showerror("Database Error", f"Error checking ledger integrity: {e}")
+            return
+        for item in self.integrity_tree.get_children():
+            self.integrity_tree.delete(item)
+        for issue in issues:
+            self.integrity_tree.insert("", "end", values=issue)
+        self.integrity_status.config(
+            text=f"{len(issues)} issue(s) found. Double-click to jump to the transaction."
+            if issues else "No issues found.")
+        if not self.integrity_frame.winfo_ismapped():
+            self.integrity_frame.pack(fill=tk.BOTH, padx=5, pady=5, side=tk.BOTTOM, before=self.trans_tree)
+
+    def on_integrity_select(self, event=None):
+        selected = self.integrity_tree.selection()
+        if selected:
+            self.focus_transaction(self.integrity_tree.item(selected[0])['values'][0])
+
+    def focus_transaction(self, trans_id):
+        """Select and scroll to a transaction, clearing filters if they hide it."""
+        self.notebook.select(self.trans_frame)
+        iid = str(trans_id)
+        if self.trans_tree.exists(iid):
+            self._pending_focus = None
+            self.trans_tree.selection_set(iid)
+            self.trans_tree.focus(iid)
+            self.trans_tree.see(iid)
+        elif self._pending_focus != trans_id:
+            self._pending_focus = trans_id
+            self.clear_filters()
+
+    def verify_acb(self):
+        """Check stored ACB state against a fresh replay on a background thread.
+
+        Runs every VERIFY_INTERVAL_MS off a read-only connection, so edits
+        are never blocked. On drift the user may repair it in one write.
+        """
+        result = {}
+
+        def verify():
+            try:
+                uri = f"{Path(DB_FILE).resolve().as_uri()}?mode=ro"
+                with contextlib.closing(sqlite3.connect(uri, uri=True)) as conn:
+                    result["version"], result["drifts"] = verify_acb_state(conn)
+            except sqlite3.Error as e:
+                result["error"] = e
+
+        def poll():
+            if worker.is_alive():
+                self.root.after(200, poll)
+                return
+            self.root.after(VERIFY_INTERVAL_MS, self.verify_acb)
+            drifts = result.get("drifts")
+            if not drifts:
+                return
+            summary = "\n".join(describe_drift(d) for d in drifts[:10])
+            if len(drifts) > 10:
+                summary += f"\n... and {len(drifts) - 10} more"
+            if not messagebox.askyesno(
+                    "ACB Drift",
+                    f"Stored ACB state differs from the ledger in {len(drifts)} place(s):\n\n"
+                    f"{summary}\n\nRepair now?"):
+                return
+            try:
+                with contextlib.closing(sqlite3.connect(DB_FILE)) as conn:
+                    repaired = repair_acb_state(conn, result["version"], drifts)
+            except sqlite3.Error as e:
+                messagebox.showerror("Database Error", f"Error repairing ACB state: {e}")
+                return
+            if repaired:
+                self.load_data()
+            else:
+                messagebox.showinfo("ACB Drift", "The ledger changed during verification; it will be checked again.")
+
+        worker = threading.Thread(target=verify, daemon=True)
+        worker.start()
+        self.root.after(200, poll)
+
+    def load_charts(self):
+        """Rebuild the running-state series on a worker thread, then redraw."""
+        result = {}
+
+        def build():
+            try:
+                with sqlite3.connect(DB_FILE) as conn:
+                    result["series"] = build_portfolio_series(conn)
+            except sqlite3.Error as e:
+                result["error"] = e
+
+        def poll():
+            if worker.is_alive():
+                self.root.after(50, poll)
+            elif "error" in result:
+                messagebox.showerror("Database Error", f"Error loading chart data: {result['error']}")
+            else:
+                self.chart_series = result["series"]
+                tokens = sorted(t for t in self.chart_series if t not in (TOTAL_ACB_SERIES, "GAS_FEES"))
+                self.chart_token['values'] = [TOTAL_ACB_SERIES] + tokens
+                if self.chart_token_var.get() not in self.chart_token['values']:
+                    self.chart_token_var.set(TOTAL_ACB_SERIES)
+                self.show_chart()
+
+        self.chart.delete("all")
+        self.chart.create_text(self.chart.winfo_width() // 2, self.chart.winfo_height() // 2,
+                               text="Loading...", fill="gray")
+        worker = threading.Thread(target=build, daemon=True)
+        worker.start()
+        self.root.after(50, poll)
+
+    def show_chart(self):
+        token = self.chart_token_var.get()
+        metric = "units" if self.chart_metric_var.get() == "Units" and token != TOTAL_ACB_SERIES else "acb"
+        entry = self.chart_series.get(token)
+        series = entry[metric] if entry else None
+        label = f"{token} - {'Units held' if metric == 'units' else 'Total ACB (CAD)'}"
+        self.chart.set_series(series, label)
+
+    def run_simulation(self):
+        """Evaluate the what-if orders against the current ACB state."""
+        orders = [line.strip() for line in self.sim_text.get("1.0", tk.END).splitlines() if line.strip()]
+        for item in self.sim_tree.get_children():
+            self.sim_tree.delete(item)
+        if not orders:
+            self.sim_total.config(text="")
+            return
+        try:
+            with sqlite3.connect(DB_FILE) as conn:
+                acb_state = load_acb_state(conn)
+            results = simulate_orders(acb_state, orders)
+        except (ValueError, decimal.InvalidOperation) as e:
+            messagebox.showerror("Simulation Error", str(e))
+            return
+        except sqlite3.Error as e:
+            messagebox.showerror("Database Error", f"Error reading ACB state: {e}")
+            return
+
+        total = 0.0
+        for r in results:
+            gain = float(r.realized_gain) if r.realized_gain is not None else None
+            if gain is not None:
+                total += gain
+            self.sim_tree.insert("", "end", values=(
+                r.order,
+                f"${float(r.proceeds):.2f}",
+                f"${float(r.cost_basis):.2f}",
+                f"${gain:.2f}" if gain is not None else "",
+                f"{float(r.units_left):.8f}",
+                f"${float(r.acb_per_unit_after):.4f}",
+                r.warning
+            ))
+        self.sim_total.config(text=f"Total realized gain: ${total:.2f} (superficial-loss rules not applied)")
+
+    def currency_choices(self):
+        try:
+            with sqlite3.connect(DB_FILE) as conn:
+                return fx_currencies(conn)
+        except sqlite3.Error:
+            return ["CAD"]
+
+    def receipt_token_map(self):
+        try:
+            with sqlite3.connect(DB_FILE) as conn:
+                return load_receipt_tokens(conn)
+        except sqlite3.Error:
+            return {}
+
+    def edit_receipt_tokens(self):
+        ReceiptTokensDialog(self.root)
+        self.stale_tabs.add(str(self.report_frame))
+
+    def load_fx_rates(self):
+        """Load daily exchange rates from a Bank of Canada CSV file."""
+        path = filedialog.askopenfilename(
+            filetypes=[("CSV files", "*.csv")],
+            title="Load Bank of Canada Exchange Rates"
+        )
+        if not path:
+            return
+        try:
+            with sqlite3.connect(DB_FILE) as conn:
+                count = load_boc_fx_csv(conn, path)
+                conn.commit()
+        except Exception as e:
+            messagebox.showerror("Import Error", f"Failed to load exchange rates:\n{e}")
+            return
+        messagebox.showinfo("Exchange Rates", f"Loaded {count} daily rate(s).")
+
+    def import_prices(self):
+        """Import daily CAD price history from a CSV file."""
+        path = filedialog.askopenfilename(
+            filetypes=[("CSV files", "*.csv")],
+            title="Import Price History"
+        )
+        if not path:
+            return
+        try:
+            try:
+                counts = self.prices.import_csv(path)
+            except ValueError as e:
+                if "no token column" not in str(e):
+                    raise
+                token = simpledialog.askstring("Import Prices", "Token for this price file:", parent=self.root)
+                if not token:
+                    return
+                counts = self.prices.import_csv(path, token=token.strip())
+        except Exception as e:
+            messagebox.showerror("Import Error", f"Failed to import prices:\n{e}")
+            return
+        self.load_acb_summary()
+        summary = "\n".join(f"{token}: {count} day(s)" for token, count in sorted(counts.items()))
+        messagebox.showinfo("Import Prices", f"Imported price history:\n{summary}")
+
+    def close_tax_year(self):
+        """Archive a filed tax year and carry its closing balances forward."""
+        try:
+            with sqlite3.connect(DB_FILE) as conn:
+                latest = closed_through(conn)
+        except sqlite3.Error as e:
+            messagebox.showerror("Database Error", f"Error reading closed years: {e}")
+            return
+        prompt = "Close every tax year up to and including:"
+        if latest is not None:
+            prompt += f"\n(closed through {latest})"
+        year = simpledialog.askinteger("Close Tax Year", prompt, initialvalue=datetime.now().year - 1,
+                                       parent=self.root)
+        if year is None or not messagebox.askyesno(
+                "Close Tax Year",
+                f"Archive all transactions through {year}? They become read-only until the year is reopened."):
+            return
+        backup_database()
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.execute('BEGIN')
+            try:
+                archived = close_tax_year(conn, year)
+                self.recompute_acb(conn)
+                conn.commit()
+            except (ValueError, sqlite3.Error) as e:
+                conn.rollback()
+                messagebox.showerror("Close Tax Year", f"Failed to close {year}: {e}")
+                return
+        messagebox.showinfo("Close Tax Year", f"Archived {archived} transaction(s) through {year}.")
+        self.load_data()
+
+    def reopen_tax_year(self):
+        """Move the latest closed year back into the live ledger."""
+        try:
+            with sqlite3.connect(DB_FILE) as conn:
+                latest = closed_through(conn)
+        except sqlite3.Error as e:
+            messagebox.showerror("Database Error", f"Error reading closed years: {e}")
+            return
+        if latest is None:
+            messagebox.showinfo("Reopen Tax Year", "No tax year is closed.")
+            return
+        if not messagebox.askyesno("Reopen Tax Year", f"Reopen {latest} and restore its transactions to the ledger?"):
+            return
+        backup_database()
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.execute('BEGIN')
+            try:
+                restored = reopen_tax_year(conn, latest)
+                self.recompute_acb(conn)
+                conn.commit()
+            except (ValueError, sqlite3.Error) as e:
+                conn.rollback()
+                messagebox.showerror("Reopen Tax Year", f"Failed to reopen {latest}: {e}")
+                return
+        messagebox.showinfo("Reopen Tax Year", f"Restored {restored} transaction(s) from {latest}.")
+        self.load_data()
+
+    def export_snapshot(self):
+        """Export a columnar snapshot of the ledger for analysis."""
+        directory = filedialog.askdirectory(title="Choose Snapshot Folder", mustexist=False)
+        if not directory:
+            return
+        try:
+            with sqlite3.connect(DB_FILE) as conn:
+                manifest = export_snapshot(conn, directory)
+            rows = manifest["tables"]["transactions"]["rows"]
+            messagebox.showinfo("Export", f"Snapshot of {rows} transaction(s) written to:\n{directory}")
+        except Exception as e:
+            messagebox.showerror("Export Error", f"Failed to export snapshot:\n{e}")
+
+    def export_schedule3(self):
+        """Export capital-gains dispositions for one tax year to CSV."""
+        year = simpledialog.askinteger(
+            "Schedule 3", "Tax year:", parent=self.root,
+            initialvalue=datetime.now().year - 1, minvalue=1900, maxvalue=9999)
+        if year is None:
+            return
+        path = filedialog.asksaveasfilename(
+            defaultextension=".csv",
+            filetypes=[("CSV files", "*.csv")],
+            initialfile=f"schedule3_{year}.csv",
+            title="Save Schedule 3 Report"
+        )
+        if not path:
+            return
+
+        try:
+            with sqlite3.connect(DB_FILE) as conn:
+                count = export_schedule3_csv(conn, year, path)
+            messagebox.showinfo("Export", f"{count} disposition(s) for {year} exported to:\n{path}")
+        except Exception as e:
+            messagebox.showerror("Export Error", f"Failed to export Schedule 3:\n{e}")
+
+    def import_csv(self):
+        """Import transactions from a CSV file, skipping ones already in the ledger."""
+        path = filedialog.askopenfilename(
+            filetypes=[("CSV files", "*.csv")],
+            title="Import Transactions"
+        )
+        if not path:
+            return
+        merge = messagebox.askyesnocancel(
+            "Duplicates",
+            "Merge duplicate rows into existing transactions?\n\n"
+            "Yes: fill in missing notes and fees\nNo: skip duplicates")
+        if merge is None:
+            return
+
+        backup_database()
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.execute('BEGIN')
+            try:
+                inserted, duplicates = import_transactions_csv(conn, path, merge=merge)
+                self.recompute_acb(conn)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                messagebox.showerror("Import Error", f"Failed to import CSV:\n{e}")
+                return
+
+        self.load_data()
+        messagebox.showinfo("Import", f"Imported {inserted} transaction(s).\n"
+                                      f"{duplicates} duplicate(s) {'merged' if merge else 'skipped'}.")
+
+    def find_duplicates(self):
+        """Report groups of transactions that look like duplicates."""
+        try:
+            with sqlite3.connect(DB_FILE) as conn:
+                groups = scan_duplicate_transactions(conn)
+        except sqlite3.Error as e:
+            messagebox.showerror("Database Error", f"Error scanning for duplicates: {e}")
+            return
+        if not groups:
+            messagebox.showinfo("Duplicates", "No likely duplicate transactions found.")
+            return
+        lines = [f"IDs {', '.join(str(i) for i in ids)}" for ids in groups[:20]]
+        if len(groups) > 20:
+            lines.append(f"...and {len(groups) - 20} more group(s)")
+        messagebox.showwarning("Duplicates", f"{len(groups)} group(s) of likely duplicates:\n\n" + "\n".join(lines))
+
+class ReadOnlyPool:
+    """A fixed set of read-only connections shared by worker threads.
+
+    In WAL mode these readers never block, or are blocked by, the writer.
+    """
+
+    def __init__(self, db_file, size=4):
+        uri = f"{Path(db_file).resolve().as_uri()}?mode=ro"
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(sqlite3.connect(uri, uri=True, check_same_thread=False))
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def close(self):
+        while not self._idle.empty():
+            self._idle.get_nowait().close()
+
+
+def api_holdings(conn, params):
+    holdings = []
+    for token, state in sorted(load_acb_state(conn).items()):
+        units = state.units_held
+        if units > 0:
+            holdings.append({
+                "token": token,
+                "units": float(units),
+                "total_acb": float(state.total_acb),
+                "acb_per_unit": float(state.acb_per_unit()),
+            })
+    return {"holdings": holdings}
+
+
+def api_acb(conn, params):
+    as_of = normalize_date(params.get("date", datetime.now().strftime("%Y-%m-%d")))
+    rows, acb_state, acquisitions = replay_source(conn, as_of)
+    for _ in replay_ledger(rows, acb_state, acquisitions):
+        pass
+    tokens = {
+        token: {"units": float(state.units_held), "total_acb": float(state.total_acb)}
+        for token, state in sorted(acb_state.items())
+        if state.units_held > 0
+    }
+    return {"date": as_of, "acb": tokens}
+
+
+def api_gains(conn, params):
+    year = int(params.get("year", datetime.now().year))
+    year_prefix = f"{year:04d}-"
+    gains = defaultdict(lambda: {"realized_gain": 0.0, "denied_loss": 0.0, "dispositions": 0})
+    for step in replay_ledger(*replay_source(conn, f"{year:04d}-12-31")):
+        if step.realized_gain is None or not step.date.startswith(year_prefix):
+            continue
+        totals = gains[step.disposed_token]
+        totals["realized_gain"] += float(step.realized_gain)
+        totals["denied_loss"] += float(step.denied_loss)
+        totals["dispositions"] += 1
+    return {
+        "year": year,
+        "total_realized_gain": sum(g["realized_gain"] for g in gains.values()),
+        "tokens": dict(sorted(gains.items())),
+    }
+
+
+def api_transactions(conn, params):
+    page = max(1, int(params.get("page", 1)))
+    size = min(1000, max(1, int(params.get("size", 100))))
+    cur = conn.execute("""
+        SELECT id, date, action, token, token_amount, cad_amount,
+               sent_token, sent_amount, sent_cad, fee_cad, gas_cad, notes,
+               realized_gain, units_after, acb_per_unit_after, denied_loss
+        FROM transactions
+        LEFT JOIN transaction_acb ON transaction_acb.transaction_id = transactions.id
+        ORDER BY date DESC, id DESC
+        LIMIT ? OFFSET ?
+    """, (size, (page - 1) * size))
+    columns = [d[0] for d in cur.description]
+    total = conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+    return {
+        "page": page,
+        "size": size,
+        "total": total,
+        "transactions": [dict(zip(columns, row)) for row in cur],
+    }
+
+
+API_ROUTES = {
+    "/holdings": api_holdings,
+    "/acb": api_acb,
+    "/gains": api_gains,
+    "/transactions": api_transactions,
+}
+
+
+class LedgerAPIServer:
+    """Read-only JSON API over the ledger, bound to localhost.
+
+    Responses are cached per ledger version, path and query. Entries for
+    older versions are dropped once a newer version is seen.
+    """
+
+    def __init__(self, db_file, host=API_HOST, port=API_PORT, pool_size=4):
+        self.host = host
+        self.port = port
+        self.pool = ReadOnlyPool(db_file, pool_size)
+        self._cache = {}
+        self._cache_version = None
+        self._cache_lock = threading.Lock()
+
+    def respond(self, path, params):
+        """Return (status, body bytes) for a GET request. Runs on a worker thread."""
+        handler = API_ROUTES.get(path)
+        if handler is None:
+            return 404, {"error": f"Unknown endpoint {path}", "endpoints": sorted(API_ROUTES)}
+        with self.pool.connection() as conn:
+            version = ledger_version(conn)
+            # The version is part of the key, so a body built from an older
+            # read can never be served for a newer ledger.
+            key = (version, path, tuple(sorted(params.items())))
+            body = self._cache.get(key)
+            if body is None:
+                try:
+                    body = json.dumps(handler(conn, params)).encode('utf-8')
+                except ValueError as e:
+                    return 400, {"error": str(e)}
+                with self._cache_lock:
+                    if self._cache_version is None or version > self._cache_version:
+                        self._cache = {}
+                        self._cache_version = version
+                    if version == self._cache_version:
+                        self._cache[key] = body
+        return 200, body
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            if len(request_line) < 2:
+                status, body = 400, {"error": "Bad request"}
+            elif request_line[0] != "GET":
+                status, body = 405, {"error": "Only GET is supported"}
+            else:
+                url = urlsplit(request_line[1])
+                params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                loop = asyncio.get_running_loop()
+                try:
+                    status, body = await loop.run_in_executor(None, self.respond, url.path.rstrip("/") or "/", params)
+                except Exception as e:
+                    status, body = 500, {"error": f"{type(e).__name__}: {e}"}
+            if not isinstance(body, bytes):
+                body = json.dumps(body).encode('utf-8')
+            reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                      500: "Internal Server Error"}[status]
+            writer.write(
+                f"HTTP/1.1 {status} {reason}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode('latin-1') + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve_forever(self):
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        print(f"Ledge API listening on http://{self.host}:{self.port}/ ({', '.join(sorted(API_ROUTES))})")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.pool.close()
+
+
+def benchmark_startup():
+    """Print time to first paint and time until the visible tab is filled."""
+    start = time.perf_counter()
+    root = tk.Tk()
+    app = CryptoACBApp(root)
+    root.update_idletasks()
+    first_paint = time.perf_counter() - start
+    while not app.startup_complete:
+        root.update()
+    ready = time.perf_counter() - start
+    root.destroy()
+    print(f"First paint: {first_paint * 1000:.1f} ms")
+    print(f"Visible tab loaded: {ready * 1000:.1f} ms")
+
+
+@contextlib.contextmanager
+def load_report_source(snapshot_dir=None):
+    """Yield (rows, acb_state, acquisitions) for a report replay from a snapshot or the database.
+
+    The rows are read lazily, so replay them inside the with block; the
+    database connection is closed, or the snapshot unmapped, when it exits.
+    """
+    if not snapshot_dir:
+        with contextlib.closing(sqlite3.connect(DB_FILE)) as conn:
+            yield replay_source(conn)
+        return
+    with Snapshot(snapshot_dir) as snapshot:
+        acb_state = new_acb_state()
+        opening = []
+        for token, date, total_acb, units_held in snapshot.opening_balances():
+            acb_state[token] = TokenState(to_decimal(total_acb), to_decimal(units_held))
+            opening.append((token, date, units_held))
+        yield (snapshot.iter_ledger_rows(), acb_state,
+               AcquisitionIndex.from_rows(snapshot.iter_ledger_rows(), opening, snapshot.closing_acquisitions()))
+
+
+def float_report_baseline(rows):
+    """The report's running totals in plain floats, as it was computed before the Decimal engine.
+
+    Only used by benchmark_report as the reference timing; no superficial
+    loss rule and no rounding guarantees.
+    """
+    acb = defaultdict(lambda: [0.0, 0.0])
+    totals = defaultdict(float)
+
+    def dispose(state, units):
+        if state[1] > 0:
+            cost_basis = state[0] / state[1] * units
+            state[0] = max(0.0, state[0] - cost_basis)
+            state[1] = max(0.0, state[1] - units)
+            return cost_basis
+        return 0.0
+
+    for _, _, token, action, token_amt, cad_amt, sent_token, sent_amt, sent_cad, fee_cad, gas_cad in rows:
+        fee_cad = fee_cad or 0.0
+        totals["fees"] += fee_cad
+        totals["gas"] += gas_cad or 0.0
+        state = acb[token]
+        if action == "Buy" or action == "Reward":
+            state[0] += cad_amt + (fee_cad if action == "Buy" else 0.0)
+            state[1] += token_amt
+        elif action == "Sell":
+            totals["gain"] += cad_amt - fee_cad - dispose(state, token_amt)
+        elif action == "Trade":
+            if sent_token and sent_amt and sent_cad is not None:
+                totals["gain"] += sent_cad - dispose(acb[sent_token], sent_amt)
+            state[0] += cad_amt + fee_cad
+            state[1] += token_amt
+        elif action == "Stake" or action == "Unstake":
+            moved = dispose(state, token_amt)
+            acb[sent_token][0] += moved
+            acb[sent_token][1] += sent_amt or 0.0
+        elif action == "Fee":
+            totals["gain"] -= dispose(state, token_amt) + cad_amt
+    return totals
+
+
+def benchmark_report(snapshot_dir=None):
+    """Time a full report replay from the database and, if given, a snapshot.
+
+    The float baseline replays the same rows the way the report did before
+    it moved to Decimal, as the reference the exact report is measured against.
+    The exact replay is also timed without the superficial-loss rule, which
+    the float report never applied.
+
+    The original target, an exact report no slower than the float one, is
+    not met and is an accepted deviation. Exact cents cost one Decimal per
+    amount and Decimal arithmetic per row. The superficial-loss rule costs
+    an index build and a window lookup per loss. On a 100k-200k row ledger
+    the full report measured 2.4x to 6x the float baseline, depending on
+    the machine and source. The verdict line below reports the ratio of the
+    current run rather than a pass.
+    """
+    with contextlib.closing(sqlite3.connect(DB_FILE)) as conn:
+        start = time.perf_counter()
+        float_report_baseline(conn.execute(f"SELECT {LEDGER_COLUMNS} FROM transactions ORDER BY date, id"))
+        baseline = time.perf_counter() - start
+
+        start = time.perf_counter()
+        compute_report_data(conn.execute(f"SELECT {LEDGER_COLUMNS} FROM transactions ORDER BY date, id"),
+                            opening_acb_state(conn))
+        exact_only = time.perf_counter() - start
+    print(f"float baseline: query and replay {baseline * 1000:.0f} ms")
+    print(f"exact, no superficial-loss rule: query and replay {exact_only * 1000:.0f} ms "
+          f"({exact_only / max(baseline, 1e-9):.2f}x float baseline)")
+
+    worst = 0.0
+    sources = [("sqlite", None)] + ([("snapshot", snapshot_dir)] if snapshot_dir else [])
+    for name, source in sources:
+        start = time.perf_counter()
+        with load_report_source(source) as source:
+            loaded = time.perf_counter()
+            data = compute_report_data(*source)
+            done = time.perf_counter()
+        count = sum(data["action_counts"].values())
+        ratio = (done - start) / max(baseline, 1e-9)
+        worst = max(worst, ratio)
+        print(f"{name}: {count} rows, index {(loaded - start) * 1000:.0f} ms, "
+              f"replay {(done - loaded) * 1000:.0f} ms ({count / max(done - loaded, 1e-9):,.0f} rows/s), "
+              f"total {ratio:.2f}x float baseline")
+    verdict = "met" if worst <= 1.0 else "NOT met (accepted deviation, see benchmark_report)"
+    print(f"target, exact report no slower than float baseline: {verdict}; worst {worst:.2f}x")
+
+
+def main():
+    global DB_FILE
+    parser = argparse.ArgumentParser(description="Ledge - Canadian ACB crypto ledger")
+    parser.add_argument("--db", default=DB_FILE, help="ledger database file (default: %(default)s)")
+    parser.add_argument("--benchmark-startup", action="store_true",
+                        help="measure time to first paint and exit")
+    parser.add_argument("--schedule3", type=int, metavar="YEAR",
+                        help="write Schedule 3 dispositions for YEAR to CSV and exit")
+    parser.add_argument("--out", help="output file for headless exports")
+    parser.add_argument("--report", action="store_true", help="print the report and exit")
+    parser.add_argument("--benchmark-report", action="store_true", help="time a full report replay and exit")
+    parser.add_argument("--snapshot", metavar="DIR", help="read --report/--benchmark-report input from a snapshot")
+    parser.add_argument("--export-snapshot", metavar="DIR", help="write a columnar snapshot and exit")
+    parser.add_argument("--verify-acb", action="store_true",
+                        help="check stored ACB state against a replay and exit (status 1 on drift)")
+    parser.add_argument("--repair", action="store_true", help="with --verify-acb, fix any drift found")
+    parser.add_argument("--serve", action="store_true",
+                        help=f"run the read-only JSON API on {API_HOST} instead of the GUI")
+    parser.add_argument("--port", type=int, default=API_PORT, help="API port (default: %(default)s)")
+    args = parser.parse_args()
+    DB_FILE = args.db
+
+    if args.serve:
+        init_db(interactive=False)
+        try:
+            asyncio.run(LedgerAPIServer(DB_FILE, port=args.port).serve_forever())
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.verify_acb:
+        init_db(interactive=False)
+        with contextlib.closing(sqlite3.connect(DB_FILE)) as conn:
+            version, drifts = verify_acb_state(conn)
+            for drift in drifts:
+                print(describe_drift(drift))
+            if drifts and args.repair:
+                if repair_acb_state(conn, version, drifts):
+                    print(f"Repaired {len(drifts)} difference(s)")
+                else:
+                    print("Ledger changed during verification; run again")
+        print(f"{len(drifts)} difference(s) at ledger version {version}")
+        sys.exit(1 if drifts and not args.repair else 0)
+
+    if args.export_snapshot:
+        init_db(interactive=False)
+        with sqlite3.connect(DB_FILE) as conn:
+            manifest = export_snapshot(conn, args.export_snapshot)
+        print(f"Wrote snapshot of {manifest['tables']['transactions']['rows']} transaction(s) to {args.export_snapshot}")
+        return
+
+    if args.report or args.benchmark_report:
+        if not args.snapshot:
+            init_db(interactive=False)
+        if args.benchmark_report:
+            benchmark_report(args.snapshot)
+        else:
+            with load_report_source(args.snapshot) as source:
+                data = compute_report_data(*source)
+            if args.snapshot:
+                with Snapshot(args.snapshot) as snapshot:
+                    data["closed_through"] = snapshot.manifest.get("closed_through")
+            else:
+                with sqlite3.connect(DB_FILE) as conn:
+                    data["closed_through"] = closed_through(conn)
+                    data["staking_positions"] = staking_report(conn, PriceStore(), datetime.now().strftime("%Y-%m-%d"))
+            print(format_report(data))
+        return
+
+    if args.schedule3 is not None:
+        path = args.out or f"schedule3_{args.schedule3}.csv"
+        init_db(interactive=False)
+        with sqlite3.connect(DB_FILE) as conn:
+            count = export_schedule3_csv(conn, args.schedule3, path)
+        print(f"Wrote {count} disposition(s) for {args.schedule3} to {path}")
+        return
+
+    if args.benchmark_startup:
+        benchmark_startup()
+        return
+
     root = tk.Tk()
     app = CryptoACBApp(root)
     root.mainloop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+import contextlib
+import csv
+import datetime
+import decimal
+import json
+import sqlite3
+
+import pytest
+
+import ledge
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    # Backups are written relative to the working directory.
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ledge, "DB_FILE", str(tmp_path / "ledge.db"))
+    ledge.init_db(interactive=False)
+    with contextlib.closing(sqlite3.connect(ledge.DB_FILE)) as conn:
+        yield conn
+
+
+def import_rows(conn, path, rows):
+    """Import rows of {column header: value} through the CSV importer."""
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=list(ledge.IMPORT_COLUMNS))
+        writer.writeheader()
+        writer.writerows(rows)
+    with conn:
+        return ledge.import_transactions_csv(conn, path)
+
+
+def test_fee_disposition_carries_its_acb(conn, tmp_path):
+    import_rows(conn, tmp_path / "fee.csv", [
+        {"Date": "2024-01-05", "Action": "Buy", "Received Token": "ETH",
+         "Received Amount": "2", "Received CAD": "4000"},
+        {"Date": "2024-02-10", "Action": "Fee", "Received Token": "ETH",
+         "Received Amount": "0.01", "Received CAD": "25"},
+    ])
+    lines = list(ledge.iter_schedule3(conn, 2024))
+    assert len(lines) == 1
+    date, _, units, proceeds, acb, outlays, gain, denied = lines[0]
+    assert date == "2024-02-10"
+    assert units == decimal.Decimal("0.01")
+    assert acb == decimal.Decimal("20.00")
+    assert outlays == decimal.Decimal("25.00")
+    assert proceeds == 0
+    assert gain == proceeds - acb - outlays == decimal.Decimal("-45.00")
+
+
+def test_close_tax_year_waits_for_superficial_loss_window(conn, tmp_path):
+    import_rows(conn, tmp_path / "year.csv", [
+        {"Date": "2024-06-01", "Action": "Buy", "Received Token": "BTC",
+         "Received Amount": "1", "Received CAD": "50000"},
+        {"Date": "2024-12-30", "Action": "Sell", "Received Token": "BTC",
+         "Received Amount": "1", "Received CAD": "40000"},
+    ])
+    with pytest.raises(ValueError, match="2025-01-31"):
+        ledge.close_tax_year(conn, 2024, today=datetime.date(2025, 1, 30))
+    assert ledge.closed_through(conn) is None
+
+    with conn:
+        assert ledge.close_tax_year(conn, 2024, today=datetime.date(2025, 1, 31)) == 2
+    assert ledge.closed_through(conn) == 2024
+
+
+def test_reimport_after_editing_a_repeated_row(conn, tmp_path):
+    buy = {"Date": "2024-03-01", "Action": "Buy", "Received Token": "ETH",
+           "Received Amount": "1", "Received CAD": "4000"}
+    assert import_rows(conn, tmp_path / "twice.csv", [buy, buy]) == (2, 0)
+    first, second = (row[0] for row in conn.execute("SELECT id FROM transactions ORDER BY id"))
+
+    # Edit the first repeat the way the transaction dialog saves it.
+    with conn:
+        old = conn.execute("SELECT fingerprint FROM transactions WHERE id = ?", (first,)).fetchone()[0]
+        base = ledge.transaction_fingerprint("2024-03-01", "Buy", "ETH", 1.5, 6000.0)
+        fingerprint, _ = ledge.next_free_fingerprint(conn, base, exclude_id=first)
+        conn.execute("UPDATE transactions SET token_amount = 1.5, cad_amount = 6000.0, fingerprint = ? WHERE id = ?",
+                     (fingerprint, first))
+        ledge.renumber_fingerprints(conn, old)
+        ledge.renumber_fingerprints(conn, fingerprint)
+
+    # The untouched repeat is now the first occurrence, so importing it again is a duplicate.
+    assert import_rows(conn, tmp_path / "once.csv", [buy]) == (0, 1)
+    assert conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0] == 2
+    assert conn.execute("SELECT fingerprint FROM transactions WHERE id = ?", (second,)).fetchone()[0] == old
+
+
+def test_snapshot_report_matches_database_after_close(conn, tmp_path):
+    import_rows(conn, tmp_path / "eth.csv", [
+        {"Date": "2023-06-01", "Action": "Buy", "Received Token": "ETH",
+         "Received Amount": "2", "Received CAD": "6000"},
+        {"Date": "2023-12-20", "Action": "Buy", "Received Token": "ETH",
+         "Received Amount": "1", "Received CAD": "3200"},
+        {"Date": "2024-01-05", "Action": "Sell", "Received Token": "ETH",
+         "Received Amount": "1", "Received CAD": "2300"},
+    ])
+    with conn:
+        ledge.close_tax_year(conn, 2023, today=datetime.date(2030, 1, 1))
+    ledge.export_snapshot(conn, tmp_path / "snapshot")
+
+    with ledge.load_report_source() as source:
+        from_db = ledge.compute_report_data(*source)
+    with ledge.load_report_source(tmp_path / "snapshot") as source:
+        from_snapshot = ledge.compute_report_data(*source)
+
+    # The December buy is archived but still makes the January loss superficial.
+    assert from_db["token_denied"] == {"ETH": decimal.Decimal("766.67")}
+    assert from_db["total_realized_gain"] == decimal.Decimal("0.00")
+    for key in ("total_realized_gain", "token_gains", "token_denied", "current_holdings"):
+        assert from_snapshot[key] == from_db[key]
+
+
+def test_imported_foreign_amounts_are_rounded_like_the_dialog(conn, tmp_path):
+    with conn:
+        conn.execute("INSERT INTO fx_rates (currency, date, rate) VALUES ('USD', '2024-04-01', 1.3547)")
+    import_rows(conn, tmp_path / "usd.csv", [
+        {"Date": "2024-04-02", "Action": "Buy", "Received Token": "BTC", "Received Amount": "0.1",
+         "Received CAD": "6543.21", "Exchange Fee (CAD)": "4.93", "Currency": "USD"},
+    ])
+    stored = conn.execute("SELECT cad_amount, fee_cad, native_currency, fx_rate FROM transactions").fetchone()
+    assert stored == ledge.convert_to_cad(1.3547, 6543.21, 4.93) + ("USD", 1.3547)
+    assert stored[:2] == (8864.09, 6.68)
+
+
+def test_staking_report_lists_partial_unstakes(conn, tmp_path):
+    import_rows(conn, tmp_path / "stake.csv", [
+        {"Date": "2024-01-02", "Action": "Buy", "Received Token": "DOT",
+         "Received Amount": "10", "Received CAD": "100"},
+        {"Date": "2024-01-03", "Action": "Stake", "Received Token": "DOT", "Received Amount": "10",
+         "Received CAD": "100", "Sent Token": "stDOT", "Sent Amount": "10", "Sent CAD": "100"},
+        {"Date": "2024-03-01", "Action": "Unstake", "Received Token": "stDOT", "Received Amount": "4",
+         "Received CAD": "40", "Sent Token": "DOT", "Sent Amount": "4", "Sent CAD": "40"},
+    ])
+    stake_id, unstake_id = (row[0] for row in conn.execute(
+        "SELECT id FROM transactions WHERE action IN ('Stake', 'Unstake') ORDER BY date"))
+
+    [position] = ledge.staking_report(conn, None, "2024-06-01")
+    assert position["stake_id"] == stake_id
+    assert position["receipt_units"] == pytest.approx(6)
+    assert position["basis_cad"] == pytest.approx(60)
+    assert position["unstakes"] == [(unstake_id, 4.0)]
+    assert f"#{unstake_id} (4.00000000)" in ledge.format_report({
+        "total_realized_gain": 0, "total_gas_loss": 0, "total_exchange_fees": 0, "net_pnl": 0,
+        "current_holdings": {}, "action_counts": {}, "token_gains": {}, "token_gas": {},
+        "token_denied": {}, "staking_positions": [position],
+    })
+
+
+def test_portfolio_total_is_unchanged_by_closing_a_year(conn, tmp_path):
+    import_rows(conn, tmp_path / "gas.csv", [
+        {"Date": "2023-03-01", "Action": "Buy", "Received Token": "ETH", "Received Amount": "2",
+         "Received CAD": "5000", "Gas Fee (CAD)": "3"},
+        {"Date": "2023-08-01", "Action": "Sell", "Received Token": "ETH", "Received Amount": "0.5",
+         "Received CAD": "1400"},
+        {"Date": "2024-02-01", "Action": "Buy", "Received Token": "BTC", "Received Amount": "0.1",
+         "Received CAD": "3500"},
+    ])
+
+    def total_acb():
+        points = ledge.build_portfolio_series(conn)[ledge.TOTAL_ACB_SERIES]["acb"]
+        return points.ys[-1]
+
+    before = total_acb()
+    with conn:
+        ledge.close_tax_year(conn, 2023, today=datetime.date(2030, 1, 1))
+    assert total_acb() == pytest.approx(before) == pytest.approx(7250)
+
+
+def schedule3(conn, year):
+    return [(line[0], line[2], line[6], line[7]) for line in ledge.iter_schedule3(conn, year)]
+
+
+def test_superficial_loss_is_denied_and_added_to_acb(conn, tmp_path):
+    import_rows(conn, tmp_path / "loss.csv", [
+        {"Date": "2024-06-01", "Action": "Buy", "Received Token": "ETH",
+         "Received Amount": "2", "Received CAD": "6000"},
+        {"Date": "2024-09-10", "Action": "Sell", "Received Token": "ETH",
+         "Received Amount": "1", "Received CAD": "2000"},
+        {"Date": "2024-09-20", "Action": "Buy", "Received Token": "ETH",
+         "Received Amount": "1", "Received CAD": "2100"},
+    ])
+    # All of the units sold were bought back within 30 days and still held: the whole loss is denied.
+    assert schedule3(conn, 2024) == [
+        ("2024-09-10", decimal.Decimal("1"), decimal.Decimal("0.00"), decimal.Decimal("1000.00")),
+    ]
+    rows, acb_state, acquisitions = ledge.replay_source(conn)
+    for _ in ledge.replay_ledger(rows, acb_state, acquisitions):
+        pass
+    assert acb_state["ETH"].total_acb == decimal.Decimal("6100")
+
+
+def test_superficial_loss_is_prorated_by_units_bought_back(conn, tmp_path):
+    import_rows(conn, tmp_path / "prorate.csv", [
+        {"Date": "2024-06-01", "Action": "Buy", "Received Token": "ETH",
+         "Received Amount": "3", "Received CAD": "9000"},
+        {"Date": "2024-09-10", "Action": "Sell", "Received Token": "ETH",
+         "Received Amount": "2", "Received CAD": "4000"},
+        {"Date": "2024-09-20", "Action": "Buy", "Received Token": "ETH",
+         "Received Amount": "0.5", "Received CAD": "1000"},
+    ])
+    # 0.5 of the 2 units sold were substituted, so a quarter of the 2000 loss is denied.
+    assert schedule3(conn, 2024) == [
+        ("2024-09-10", decimal.Decimal("2"), decimal.Decimal("-1500.00"), decimal.Decimal("500.00")),
+    ]
+
+
+def test_superficial_loss_is_limited_to_units_still_held(conn, tmp_path):
+    import_rows(conn, tmp_path / "held.csv", [
+        {"Date": "2024-06-01", "Action": "Buy", "Received Token": "ETH",
+         "Received Amount": "1", "Received CAD": "3000"},
+        {"Date": "2024-09-10", "Action": "Sell", "Received Token": "ETH",
+         "Received Amount": "1", "Received CAD": "2000"},
+        {"Date": "2024-09-15", "Action": "Buy", "Received Token": "ETH",
+         "Received Amount": "1", "Received CAD": "2000"},
+        {"Date": "2024-09-25", "Action": "Sell", "Received Token": "ETH",
+         "Received Amount": "0.6", "Received CAD": "2000"},
+    ])
+    # A full unit was bought back but only 0.4 is held 30 days after the sale.
+    first, second = schedule3(conn, 2024)
+    assert first == ("2024-09-10", decimal.Decimal("1"), decimal.Decimal("-600.00"), decimal.Decimal("400.00"))
+    # The denied 400 went into the ACB of the units bought back: 0.6 of 2400 is 1440.
+    assert second == ("2024-09-25", decimal.Decimal("0.6"), decimal.Decimal("560.00"), decimal.Decimal("0.00"))
+
+
+def test_migrates_a_version_0_database(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ledge, "DB_FILE", str(tmp_path / "legacy.db"))
+    with contextlib.closing(sqlite3.connect(ledge.DB_FILE)) as legacy:
+        # The schema Ledge created before migrations were versioned.
+        legacy.execute('''
+        CREATE TABLE transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date TEXT NOT NULL CHECK (date GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'),
+            token TEXT NOT NULL,
+            action TEXT NOT NULL,
+            token_amount REAL NOT NULL,
+            cad_amount REAL NOT NULL,
+            notes TEXT,
+            sent_token TEXT,
+            sent_amount REAL,
+            sent_cad REAL,
+            fee_cad REAL DEFAULT 0.0,
+            gas_cad REAL DEFAULT 0.0
+        )
+        ''')
+        legacy.execute('''
+        CREATE TABLE acb_state (
+            token TEXT PRIMARY KEY,
+            total_acb DECIMAL(28,18) NOT NULL DEFAULT 0.0,
+            units_held DECIMAL(28,18) NOT NULL DEFAULT 0.0
+        )
+        ''')
+        legacy.executemany(
+            "INSERT INTO transactions (date, token, action, token_amount, cad_amount) VALUES (?, ?, ?, ?, ?)",
+            [("2024-01-02", "BTC", "Buy", 0.5, 30000.0)] * 2 + [("2024-02-03", "BTC", "Sell", 0.25, 20000.0)])
+        legacy.commit()
+        assert legacy.execute("PRAGMA user_version").fetchone()[0] == 0
+
+    ledge.init_db(interactive=False)
+
+    with contextlib.closing(sqlite3.connect(ledge.DB_FILE)) as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == ledge.SCHEMA_VERSION
+        fingerprints = [row[0] for row in conn.execute("SELECT fingerprint FROM transactions ORDER BY id")]
+        base = ledge.transaction_fingerprint("2024-01-02", "Buy", "BTC", 0.5, 30000.0)
+        assert fingerprints[:2] == [base, f"{base}#1"]
+        assert not ledge.acb_state_is_current(conn)
+        assert ledge.closed_through(conn) is None
+        assert ledge.load_receipt_tokens(conn) is not None
+        assert [line[6] for line in ledge.iter_schedule3(conn, 2024)] == [decimal.Decimal("5000.00")]
+    assert list((tmp_path / "backups").glob("premigration_*.db"))
+    # Running again is a no-op.
+    with contextlib.closing(sqlite3.connect(ledge.DB_FILE)) as conn:
+        assert ledge.migrate_db(conn) == 0
+
+
+def test_close_and_reopen_round_trip_schedule3(conn, tmp_path):
+    rows = []
+    for year in (2022, 2023, 2024):
+        rows += [
+            {"Date": f"{year}-02-01", "Action": "Buy", "Received Token": "BTC",
+             "Received Amount": "1", "Received CAD": str(30000 + year)},
+            {"Date": f"{year}-07-01", "Action": "Sell", "Received Token": "BTC",
+             "Received Amount": "0.5", "Received CAD": "12000"},
+            {"Date": f"{year}-12-20", "Action": "Buy", "Received Token": "BTC",
+             "Received Amount": "0.2", "Received CAD": "5000"},
+        ]
+    rows.append({"Date": "2025-01-05", "Action": "Sell", "Received Token": "BTC",
+                 "Received Amount": "0.3", "Received CAD": "4000"})
+    import_rows(conn, tmp_path / "years.csv", rows)
+    years = (2022, 2023, 2024, 2025)
+    expected = {year: schedule3(conn, year) for year in years}
+    count = conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+
+    today = datetime.date(2030, 1, 1)
+    with conn:
+        ledge.close_tax_year(conn, 2022, today=today)
+    with conn:
+        ledge.close_tax_year(conn, 2024, today=today)
+    assert ledge.closed_through(conn) == 2024
+    assert {year: schedule3(conn, year) for year in years} == expected
+
+    with conn:
+        ledge.reopen_tax_year(conn, 2024)
+    assert ledge.closed_through(conn) == 2022
+    assert {year: schedule3(conn, year) for year in years} == expected
+    with conn:
+        ledge.reopen_tax_year(conn, 2022)
+    assert ledge.closed_through(conn) is None
+    assert conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0] == count
+    assert conn.execute("SELECT COUNT(*) FROM archived_transactions").fetchone()[0] == 0
+    assert {year: schedule3(conn, year) for year in years} == expected
+
+
+def test_verifier_finds_and_repairs_drift(conn, tmp_path):
+    import_rows(conn, tmp_path / "verify.csv", [
+        {"Date": "2024-01-02", "Action": "Buy", "Received Token": "SOL",
+         "Received Amount": "10", "Received CAD": "1500"},
+        {"Date": "2024-03-02", "Action": "Sell", "Received Token": "SOL",
+         "Received Amount": "4", "Received CAD": "900"},
+    ])
+    version, drifts = ledge.verify_acb_state(conn)
+    assert {drift.table for drift in drifts} == {"ledger_meta", "acb_state", "transaction_acb"}
+    assert ledge.repair_acb_state(conn, version, drifts)
+    assert ledge.verify_acb_state(conn) == (version + 1, [])
+    assert ledge.acb_state_is_current(conn)
+
+    with conn:
+        conn.execute("UPDATE acb_state SET total_acb = total_acb + 1 WHERE token = 'SOL'")
+    version, drifts = ledge.verify_acb_state(conn)
+    assert [(drift.table, drift.key) for drift in drifts] == [("acb_state", "SOL")]
+    # A write after verification makes the drifts stale, so nothing is repaired.
+    with conn:
+        conn.execute("UPDATE transactions SET notes = 'x' WHERE token = 'SOL'")
+    assert not ledge.repair_acb_state(conn, version, drifts)
+
+
+def test_api_serves_json_and_refreshes_after_a_write(conn, tmp_path):
+    import_rows(conn, tmp_path / "api.csv", [
+        {"Date": "2024-01-02", "Action": "Buy", "Received Token": "ADA",
+         "Received Amount": "100", "Received CAD": "60"},
+    ])
+    server = ledge.LedgerAPIServer(ledge.DB_FILE, pool_size=1)
+    try:
+        status, body = server.respond("/transactions", {})
+        assert status == 200
+        assert json.loads(body)["total"] == 1
+        assert server.respond("/transactions", {}) == (status, body)
+
+        import_rows(conn, tmp_path / "api2.csv", [
+            {"Date": "2024-02-02", "Action": "Buy", "Received Token": "ADA",
+             "Received Amount": "50", "Received CAD": "35"},
+        ])
+        assert json.loads(server.respond("/transactions", {})[1])["total"] == 2
+
+        status, body = server.respond("/nowhere", {})
+        assert status == 404 and "/holdings" in body["endpoints"]
+        assert server.respond("/transactions", {"page": "x"})[0] == 400
+    finally:
+        server.pool.close()